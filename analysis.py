@@ -9,6 +9,9 @@ Provides analysis functionalities
 
 import argparse
 import os
+import time
+import tracemalloc
+import random
 import numpy as np
 from config import config
 import h5py
@@ -19,8 +22,11 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt  # noqa: E402
 import conversion  # noqa: E402
 from vocal_isolation import VocalIsolation  # noqa: E402
-from data import Data  # noqa: E402
+from data import Data, remove_track_boundaries  # noqa: E402
 from normalizer import Normalizer  # noqa: E402
+from storage import Storage  # noqa: E402
+from chopper import Chopper  # noqa: E402
+from batch import Batch  # noqa: E402
 
 
 class Analysis:
@@ -309,6 +315,299 @@ class Analysis:
             os.mkdir(self.analysisPath)
         plt.savefig(os.path.join(self.analysisPath, "volume.png"))
 
+    def storage(self, tracks=5):
+        # compare size, read throughput and amplitude error
+        # of the storage formats on the first tracks of the data set
+        data = Data()
+        names = data.track_names[:int(tracks)]
+        stfts = [data.mashup[name] for name in names]
+        amplitudes = [np.abs(stft) for stft in stfts]
+
+        if not os.path.exists(self.analysisPath):
+            os.mkdir(self.analysisPath)
+        path = os.path.join(self.analysisPath, "storage.h5")
+        original = (config.storage, config.storage_compression)
+        print("format | compression | MB | read MB/s | "
+              "max relative amplitude error")
+        for storage_format in ["complex128", "complex64",
+                               "float16", "log_amplitude"]:
+            for compression in ["", "gzip", "lzf", "lz4", "blosc"]:
+                config.storage = storage_format
+                config.storage_compression = compression
+                if os.path.exists(path):
+                    os.remove(path)
+                storage = Storage(path, config.fft)
+                try:
+                    with h5py.File(path, "w") as h5f:
+                        for name, stft in zip(names, stfts):
+                            storage.write(h5f, name, stft)
+                except ImportError:
+                    print(storage_format, compression, "not available")
+                    continue
+                size = os.path.getsize(path) / 1024**2
+
+                h5f = storage.open()
+                start = time.time()
+                decoded = [storage.read(h5f[name]) for name in names]
+                seconds = time.time() - start
+                h5f.close()
+
+                error = max(np.max(np.abs(np.abs(d) - a)) / np.max(a)
+                            for d, a in zip(decoded, amplitudes))
+                # throughput in MB of complex128 spectrograms per second
+                total = sum(stft.size * 16 for stft in stfts) / 1024**2
+                print("%s | %s | %.1f | %.1f | %g"
+                      % (storage_format, compression or "none",
+                         size, total / seconds, error))
+        config.storage, config.storage_compression = original
+        if os.path.exists(path):
+            os.remove(path)
+
+    def chopper(self, frames=2000, repeat=3):
+        # compare the vectorized choppers with cutting the slices
+        # one by one in loops and copying them into one array
+        # as the choppers did before, on a random track
+        # of the configured shape
+        frames = int(frames)
+        repeat = int(repeat)
+        shape = (config.fft // 2 + 1, frames, config.get_channels())
+        mashup = np.random.rand(*shape)
+        vocal = np.random.rand(*shape)
+        cases = [("tile", {"scale": 128}),
+                 ("full", {"scale": 128}),
+                 ("sliding", {"scale": 128, "step": 32}),
+                 ("sliding", {"scale": 128, "step": (16, 64)}),
+                 ("sliding_full", {"scale": 128, "step": 16}),
+                 ("filtered", {"scale": 128, "filter": "mean"}),
+                 ("filtered_full", {"scale": 128, "filter": "maximum"})]
+
+        def measure(chop):
+            # best of several runs, the first one pays for page faults
+            times = []
+            for _ in range(repeat):
+                start = time.time()
+                slices, vocal_slices = chop(mashup, vocal)
+                slices = np.asarray(slices)
+                vocal_slices = np.asarray(vocal_slices)
+                times.append(time.time() - start)
+            return slices, vocal_slices, min(times)
+
+        print("chopper | params | slices | loop s | vectorized s | "
+              "speedup | equal")
+        for upper in [False, True]:
+            for name, params in cases:
+                params["upper"] = upper
+                chopper = Chopper()
+                chopper.name = name
+                chopper.params = str(params)
+                chopper.index = False
+
+                loop, vocal_loop, loop_time = measure(
+                    lambda mashup, vocal: self._loop_chop(
+                        name, mashup, vocal, **params))
+                vectorized, vocal_vectorized, vectorized_time = \
+                    measure(chopper.get())
+
+                print("%s | %s | %d | %.3f | %.3f | %.2f | %s"
+                      % (name, params, len(loop), loop_time,
+                         vectorized_time, loop_time / vectorized_time,
+                         np.array_equal(loop, vectorized)
+                         and np.array_equal(vocal_loop, vocal_vectorized)))
+
+    def _loop_chop(self, name, mashup, vocal, scale, step=1,
+                   upper=False, filter="mean"):
+        # the choppers cutting the slices one by one as they did before
+        mashup_slices = self._loop_slices(name, mashup, scale, step, upper)
+        vocal_slices = self._loop_slices(name, vocal, scale, step, upper)
+        if name.startswith("filtered"):
+            tiles = self._loop_slices("tile", vocal, scale, step, upper)
+            mean_deviation = np.sum(tiles) / \
+                (len(tiles) * np.prod(tiles[0].shape))
+            if filter == "maximum":
+                keep = [mean_deviation < np.max(s) for s in vocal_slices]
+            else:
+                keep = [mean_deviation < np.sum(s) / np.prod(s.shape)
+                        for s in vocal_slices]
+            mashup_slices = [s for s, k in zip(mashup_slices, keep) if k]
+            vocal_slices = [s for s, k in zip(vocal_slices, keep) if k]
+        return mashup_slices, vocal_slices
+
+    def _loop_slices(self, name, matrix, scale, step, upper):
+        if isinstance(step, int):
+            time_step = freq_step = step
+        else:
+            time_step, freq_step = step
+        limit = matrix.shape[0] // 2 if upper else matrix.shape[0]
+        rows = slice(0, matrix.shape[0] // 2) if upper else slice(1, None)
+        slices = []
+        if name in ["tile", "filtered"]:
+            for t in range(matrix.shape[1] // scale):
+                for f in range(limit // scale):
+                    slices.append(matrix[f * scale: (f + 1) * scale,
+                                         t * scale: (t + 1) * scale, :])
+        elif name in ["full", "filtered_full"]:
+            for t in range(matrix.shape[1] // scale):
+                slices.append(matrix[rows, t * scale: (t + 1) * scale, :])
+        elif name == "sliding":
+            for t in range((matrix.shape[1] - scale) // time_step):
+                for f in range((limit - scale) // freq_step):
+                    slices.append(
+                        matrix[f * freq_step: f * freq_step + scale,
+                               t * time_step: t * time_step + scale, :])
+        else:
+            for t in range((matrix.shape[1] - scale) // time_step):
+                slices.append(
+                    matrix[rows, t * time_step: t * time_step + scale, :])
+        return slices
+
+    def batch(self, batches=50, batch_sizes="8,16,32,64,128"):
+        # batches per second of the batch generators compared with
+        # filling float64 batches slice by slice as they did before
+        batches = int(batches)
+        data = Data()
+        chopper = Chopper()
+        chopper.index = False
+        slices = data.prepare_data(chopper.get(), data.train_tracks)
+        tracks = data.prepare_random_data(data.train_tracks)
+        inputs = {"default": slices, "tracks": slices, "random": tracks}
+
+        def measure(generator):
+            next(generator)
+            start = time.time()
+            for _ in range(batches):
+                next(generator)
+            return batches / (time.time() - start)
+
+        print("generator | batch | slices batches/s | "
+              "vectorized batches/s | speedup")
+        original = config.batch_generator
+        for name in ["default", "tracks", "random"]:
+            config.batch_generator = name
+            features, labels = inputs[name]
+            for batch_size in [int(size) for size in batch_sizes.split(",")]:
+                if name == "default" and \
+                        batch_size > sum(len(track) for track in features):
+                    print("%s | %d | not enough slices" % (name, batch_size))
+                    continue
+                rows = measure(self._rows(name, features, labels,
+                                          batch_size))
+                vectorized = measure(Batch().get()(features, labels,
+                                                   batch_size))
+                print("%s | %d | %.1f | %.1f | %.2f"
+                      % (name, batch_size, rows, vectorized,
+                         vectorized / rows))
+        config.batch_generator = original
+
+    def _rows(self, name, features, labels, batch_size):
+        # the batch generators filling one slice at a time
+        chopper = Chopper()
+        chopparams = eval(chopper.params)
+        chopparams["slices"] = 1
+        chopper.params = str(chopparams)
+        chopper.name = "random_full" if "full" in chopper.name else "random"
+        chop = chopper.get()
+        if name == "default":
+            features = remove_track_boundaries(features)
+            labels = remove_track_boundaries(labels)
+            shape = features[0].shape
+        elif name == "tracks":
+            shape = features[0][0].shape
+        else:
+            shape = Batch()._calculate_shape(features[0].shape)
+        batch_features = np.zeros((batch_size, *shape))
+        batch_labels = np.zeros((batch_size, *shape))
+        while True:
+            for i in range(batch_size):
+                if name == "default":
+                    s = random.randrange(len(features))
+                    batch_features[i] = features[s]
+                    batch_labels[i] = labels[s]
+                    continue
+                t = random.randrange(len(features))
+                if name == "tracks":
+                    s = random.randrange(len(features[t]))
+                    batch_features[i] = features[t][s]
+                    batch_labels[i] = labels[t][s]
+                else:
+                    feature, label = chop(features[t], labels[t])
+                    batch_features[i] = feature[0]
+                    batch_labels[i] = label[0]
+            yield batch_features, batch_labels
+
+    def inference(self, frames=20000, slices="500,1000,3500",
+                  batch_sizes="1,4,8"):
+        # time and peak memory of the inference on a random track
+        # predicted slice by slice as before and in batches
+        frames = int(frames)
+        channels = config.get_channels()
+        shape = (config.fft // 2 + 1, frames, channels)
+        spectrogram = np.random.rand(*shape).astype(config.dtype)
+        bot = VocalIsolation(config)
+
+        def measure(process):
+            # only the arrays allocated by numpy are traced,
+            # not the memory of the model
+            tracemalloc.start()
+            start = time.time()
+            result = process()
+            seconds = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return result, seconds, peak / 2**20
+
+        print("slice | batch | slices s | batched s | speedup | "
+              "slices MB | batched MB | max difference")
+        original = config.inference_slice, config.inference_batch
+        for size in [int(size) for size in slices.split(",")]:
+            config.inference_slice = size
+            reference, reference_time, reference_peak = measure(
+                lambda: self._slice_by_slice(bot, spectrogram, channels))
+            for batch_size in [int(size) for size in batch_sizes.split(",")]:
+                config.inference_batch = batch_size
+                result, result_time, result_peak = measure(
+                    lambda: bot.process_spectrogram(spectrogram,
+                                                    channels)[1])
+                print("%d | %d | %.2f | %.2f | %.2f | %.0f | %.0f | %g"
+                      % (size, batch_size, reference_time, result_time,
+                         reference_time / result_time, reference_peak,
+                         result_peak, np.max(np.abs(result - reference))))
+        config.inference_slice, config.inference_batch = original
+
+    def _slice_by_slice(self, bot, spectrogram, channels):
+        # the inference predicting one slice at a time
+        chopper = Chopper()
+        chopper.name = "infer"
+        chopper.params = "{'scale': %d}" % config.inference_slice
+        normalizer = Normalizer()
+        normalize = normalizer.get(both=False)
+        denormalize = normalizer.get_reverse()
+        new_spectrogram = np.zeros((spectrogram.shape[0], 0, channels),
+                                   dtype=spectrogram.dtype)
+        for slice in chopper.get(both=False)(spectrogram):
+            # the normalizer fails on the empty last slice
+            if slice.shape[1] == 0:
+                continue
+            slice, norm = normalize(slice)
+            expanded = conversion.expand_to_grid(
+                slice, bot.peakDownscaleFactor, channels)
+            predicted = bot.model.predict(expanded[np.newaxis])[0]
+            predicted = denormalize(
+                predicted[:slice.shape[0], :slice.shape[1]], norm)
+            new_spectrogram = np.concatenate((new_spectrogram, predicted),
+                                             axis=1)
+        return new_spectrogram
+
+    def stems(self):
+        # error of the instrumental derived as mashup - vocal,
+        # measured when the spectrograms were created
+        data = Data()
+        residuals = []
+        for track in data.track_names:
+            residual = data.storage.get_track_info(track)["residual"]
+            residuals.append(residual)
+            print("%s %g" % (track, residual))
+        print("max %g" % max(residuals))
+
     def distribution(self):
         data = Data()
 
@@ -6,17 +6,35 @@ Provides different batch generation methods
 
 """
 
+import time
+import queue
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
-import random
+import console
 from config import config
-from data import remove_track_boundaries
-from chopper import Chopper
+from data import remove_track_boundaries, LazyTracks, SamplingIndex
+from chopper import Chopper, SliceIndex
+from normalizer import Normalizer
 
 
 class Batch(object):
     def __init__(self):
         self.config = config
         self.batch_generator = self.config.batch_generator
+        # processes assembling the batches (0 = in this process)
+        self.workers = self.config.batch_workers
+        # seed of the random stream of each generator
+        self.seed = self.config.get_seed()
+        # batches of the stream already trained on by a resumed training
+        self.skip = 0
+        # norms of the tracks of the remix generator (see Data.train)
+        self.norms = None
+        # energy weighted sampling of the random generators (see Data.train)
+        self.sampling = None
+        # time spent waiting for the batches
+        self.wait = 0
+        self.batches = 0
 
     def get(self):
         return getattr(self, self.batch_generator)()
@@ -51,92 +69,348 @@ class Batch(object):
     # Shuffle slices before each epoch.
     # Train with every slice for one epoch.
     def default(self):
-        def generator(features, labels, batch_size):
+        def sample(features, labels, batch_size, rng):
             # remove track boundaries
             features = remove_track_boundaries(features)
             labels = remove_track_boundaries(labels)
-            # calculate shape
-            shape = features[0].shape
-            # Create empty arrays to contain batch of features and labels
-            batch_features = np.zeros((batch_size, *shape))
-            batch_labels = np.zeros((batch_size, *shape))
             n = len(features)
-            index = list(range(n))
-            random.shuffle(index)
-            j = 0
-            while True:
-                batch_index = index[j*batch_size:(j+1)*batch_size]
-                j += 1
-                # reset to satisfy queue generation
-                if (j + 1) * batch_size > n:
-                    j = 0
-                for i in range(batch_size):
-                    batch_features[i] = features[batch_index[i]]
-                    batch_labels[i] = labels[batch_index[i]]
-                yield batch_features, batch_labels
-        return generator
+
+            def draw():
+                index = rng.permutation(n)
+                j = 0
+                while True:
+                    batch_index = index[j*batch_size:(j+1)*batch_size]
+                    j += 1
+                    # reset to satisfy queue generation
+                    if (j + 1) * batch_size > n:
+                        j = 0
+                    yield batch_index
+            return features, labels, features[0].shape, draw()
+        return self._generator(sample)
 
     # Select a slice from a random track.
     # Repeat until batch is full.
     # Not every slice is used for training.
     def tracks(self):
-        def generator(features, labels, batch_size):
-            shape = features[0][0].shape
-            # Create empty arrays to contain batch of features and labels
-            batch_features = np.zeros((batch_size, *shape))
-            batch_labels = np.zeros((batch_size, *shape))
-            n_tracks = len(features)
-            while True:
-                for i in range(batch_size):
-                    # get random track
-                    t = random.randrange(n_tracks)
-                    x_track = features[t]
-                    y_track = labels[t]
+        def sample(features, labels, batch_size, rng):
+            # the slices stay in the list of tracks,
+            # tracks without slices are never drawn
+            lengths = np.array([len(track) for track in features])
+            tracks = np.flatnonzero(lengths)
 
-                    # get random slice
-                    s = random.randrange(len(x_track))
-
-                    batch_features[i] = x_track[s]
-                    batch_labels[i] = y_track[s]
-                yield batch_features, batch_labels
-        return generator
+            def draw():
+                while True:
+                    # random slices of random tracks
+                    track = tracks[rng.integers(len(tracks),
+                                                size=batch_size)]
+                    yield track, (rng.random(batch_size)
+                                  * lengths[track]).astype(int)
+            shape = features[tracks[0]].shape[1:]
+            return features, labels, shape, draw()
+        return self._generator(sample)
 
     # Create a random slice from a random track.
     # Repeat until batch is full.
     def random(self):
-        chopper = Chopper()
+        def sample(features, labels, batch_size, rng):
+            shape = self._calculate_shape(get_shapes(features)[0])
+            return features, labels, shape, \
+                self._random_slices(labels, batch_size, rng)
+        return self._generator(sample)
 
-        # only one slices at a time is needed
-        if chopper.params:
-            chopparams = eval(chopper.params)
-        else:
-            chopparams = {}
-        chopparams["slices"] = 1
-        chopper.params = str(chopparams)
+    # Mix a random vocal slice with an instrumental slice
+    # of the same or another track at random gains.
+    # Needs the stems instead of mashup and output (see Data.train).
+    def remix(self):
+        params = eval(self.config.remix_params)
+        gain_db = params.get("gain_db", 6)
+        cross_track = params.get("cross_track", 0.5)
+        per_slice = params.get("normalize", "track") == "slice"
+        normalize_slices = Normalizer().get(copy=False)
+        normalize = Normalizer().get(both=False, copy=False)
+
+        def sample(vocals, instrumentals, batch_size, rng):
+            shape = self._calculate_shape(get_shapes(vocals)[0])
+            shape[2] = self.config.get_channels()
+            frames = np.array([shape[1] for shape in get_shapes(vocals)])
+
+            def draw():
+                for vocal in self._random_slices(vocals, batch_size, rng):
+                    track, freq, time, height, width = vocal
+                    # instrumentals of other tracks at other times
+                    other = rng.integers(len(instrumentals), size=batch_size)
+                    other = np.where(rng.random(batch_size) < cross_track,
+                                     other, track)
+                    other_time = rng.random(batch_size) \
+                        * (frames[other] - width)
+                    other_time = np.where(other == track, time,
+                                          other_time.astype(int))
+                    gains = 10 ** (rng.uniform(-gain_db, gain_db,
+                                               size=(2, batch_size)) / 20)
+                    yield vocal, (other, freq, other_time, height, width), \
+                        gains[0], gains[1]
+            return vocals, instrumentals, shape, draw()
+
+        def mix(vocals, instrumentals, batch, out_features, out_labels):
+            vocal_batch, instrumental_batch, vocal_gain, \
+                instrumental_gain = batch
+            track, freq, time, height, width = vocal_batch
+            other, _, other_time, _, _ = instrumental_batch
+            # real and imaginary part of the stems
+            shape = (len(track), height, width, 2)
+            vocal = np.empty(shape, dtype=self.config.dtype)
+            instrumental = np.empty(shape, dtype=self.config.dtype)
+            norms = {}
+            # both stems of a track are copied together,
+            # so a lazily loaded track is loaded at most once per batch
+            for t in np.unique(np.concatenate([track, other])):
+                vocal_track = vocals[t]
+                instrumental_track = instrumentals[t]
+                norms[t] = self.norms[t]
+                for i in np.flatnonzero(track == t):
+                    vocal[i] = vocal_track[freq[i]: freq[i] + height,
+                                           time[i]: time[i] + width]
+                for i in np.flatnonzero(other == t):
+                    instrumental[i] = instrumental_track[
+                        freq[i]: freq[i] + height,
+                        other_time[i]: other_time[i] + width]
+            vocal *= vocal_gain[:, np.newaxis, np.newaxis, np.newaxis]
+            instrumental *= instrumental_gain[:, np.newaxis,
+                                              np.newaxis, np.newaxis]
+            mashup = vocal + instrumental
+            output = instrumental if self.config.instrumental else vocal
+            if not self.config.learn_phase:
+                mashup = np.log1p(np.hypot(mashup[..., :1], mashup[..., 1:]))
+                output = np.log1p(np.hypot(output[..., :1], output[..., 1:]))
+            if per_slice:
+                # every slice on its own like in the inference
+                out_features[...], out_labels[...] = \
+                    normalize_slices(mashup, output)
+                return
+            # with the norm of the track of the vocal like the prepared
+            # tracks of the other generators and the validation
+            for i, t in enumerate(track):
+                out_features[i], _ = normalize(mashup[i], norm=norms[t])
+                out_labels[i], _ = normalize(output[i], norm=norms[t])
+        return self._generator(sample, mix)
+
+    def _random_slices(self, labels, batch_size, rng):
+        # (track, freq, time, height, width) of the random slices
+        # of each batch like the random choppers
+        chopper = Chopper()
+        chopparams = eval(chopper.params)
+        scale = chopparams["scale"]
+        upper = chopparams.get("upper", False)
 
         # get full or partial depending on chopper
         if "full" in chopper.name:
             chopper.name = "random_full"
         else:
             chopper.name = "random"
-        chop = chopper.get()
 
-        def generator(features, labels, batch_size):
-            shape = self._calculate_shape(features[0].shape)
-            # Create empty arrays to contain batch of features and labels
-            batch_features = np.zeros((batch_size, *shape))
-            batch_labels = np.zeros((batch_size, *shape))
-            n_tracks = len(features)
+        if self.config.sampling != "uniform":
+            sampling = self.sampling
+            if sampling is None:
+                sampling = SamplingIndex(chopper, labels,
+                                         self.config.sampling)
+                console.info("Sampling index:", sampling)
             while True:
-                for i in range(batch_size):
-                    # get random track
-                    t = random.randrange(n_tracks)
-                    x_track = features[t]
-                    y_track = labels[t]
+                track, freq, time = sampling.draw(batch_size, rng)
+                yield track, freq, time, sampling.height, scale
+
+        # lazily loaded tracks are only loaded to copy the slices
+        shapes = get_shapes(labels)
+        frames = np.array([shape[1] for shape in shapes])
+        # stands in for the tracks, which have the bins of the same FFT
+        rows = np.empty((shapes[0][0], 0))
+        while True:
+            track = rng.integers(len(labels), size=batch_size)
+            time = rng.random(batch_size) * (frames[track] - scale)
+            if chopper.name == "random_full":
+                freq, height = chopper._full_rows(rows, upper)
+                freq = np.full(batch_size, freq)
+            else:
+                limit = len(rows) // 2 if upper else len(rows)
+                freq = rng.random(batch_size) * (limit - scale)
+                height = scale
+            yield track, freq.astype(int), time.astype(int), height, scale
 
-                    feature, label = chop(x_track, y_track)
+    def _generator(self, sample, combine=None):
+        # sample returns the data, the shape of a slice and
+        # the description of the batches drawn from one stream
+        # per generator, combine copies them into the batch
+        if combine is None:
+            combine = assemble_both
 
-                    batch_features[i] = feature[0]
-                    batch_labels[i] = label[0]
+        def generator(features, labels, batch_size):
+            rng = np.random.default_rng(self.seed)
+            features, labels, shape, batches = sample(features, labels,
+                                                      batch_size, rng)
+            # only the descriptions are drawn to continue the stream
+            for _ in range(self.skip):
+                next(batches)
+            if self.workers > 0 and isinstance(features, LazyTracks):
+                console.warn("BATCH_WORKERS needs all tracks in memory "
+                             "(TRACK_CACHE=0), assembling batches in "
+                             "the training process")
+            elif self.workers > 0:
+                # the data is replaced by its shared copy,
+                # so the training set is not kept twice
+                features = share(features)
+                labels = share(labels)
+                yield from self._prefetch(features, labels, shape,
+                                          batch_size, batches, combine)
+
+            # Create empty arrays to contain batch of features and labels
+            batch_features = np.zeros((batch_size, *shape),
+                                      dtype=self.config.dtype)
+            batch_labels = np.zeros((batch_size, *shape),
+                                    dtype=self.config.dtype)
+            for batch in batches:
+                start = time.time()
+                combine(features, labels, batch,
+                        batch_features, batch_labels)
+                self.wait += time.time() - start
+                self.batches += 1
                 yield batch_features, batch_labels
         return generator
+
+    def _prefetch(self, features, labels, shape, batch_size, batches,
+                  combine):
+        # the batches are drawn here, so they do not depend
+        # on the number of workers, which only assemble them
+        # into the slots of a shared ring buffer
+        depth = max(self.config.batch_queue, 1)
+        context = multiprocessing.get_context("fork")
+        slots = (shared_empty((depth, batch_size, *shape), self.config.dtype),
+                 shared_empty((depth, batch_size, *shape), self.config.dtype))
+        jobs = context.Queue()
+        ready = context.Queue()
+        workers = [context.Process(target=produce,
+                                   args=(features, labels, combine,
+                                         slots, jobs, ready),
+                                   daemon=True)
+                   for _ in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            for slot in range(depth):
+                jobs.put((slot, next(batches)))
+            done = set()
+            k = 0
+            while True:
+                slot = k % depth
+                start = time.time()
+                while slot not in done:
+                    try:
+                        done.add(ready.get(timeout=1))
+                    except queue.Empty:
+                        if not all(worker.is_alive() for worker in workers):
+                            raise RuntimeError("A batch worker died")
+                self.wait += time.time() - start
+                self.batches += 1
+                done.remove(slot)
+                # the slot is refilled while the batch is trained on
+                batch_features = slots[0][slot].copy()
+                batch_labels = slots[1][slot].copy()
+                jobs.put((slot, next(batches)))
+                k += 1
+                yield batch_features, batch_labels
+        finally:
+            for worker in workers:
+                worker.terminate()
+
+    def __str__(self):
+        return "%.1f s waiting for %d batches (%.1f ms per batch)" % (
+            self.wait, self.batches,
+            1000 * self.wait / max(self.batches, 1))
+
+
+def assemble(data, batch, out):
+    """
+    Copy the slices of a batch into the preallocated `out`
+
+    batch: indices into the slices of `data`,
+           (track, slice) indices into a list of the slices of every track
+           or (track, freq, time, height, width) of slices of its tracks
+    """
+    if isinstance(batch, tuple) and len(batch) == 2:
+        for i, (track, index) in enumerate(zip(*batch)):
+            out[i] = data[track][index]
+        return out
+    if isinstance(batch, tuple):
+        return SliceIndex(data, *batch).gather(out=out)
+    return take(data, batch, out)
+
+
+def assemble_both(features, labels, batch, out_features, out_labels):
+    if isinstance(batch, tuple) and len(batch) == 5:
+        # the features and labels of a track are copied together,
+        # so a lazily loaded track is loaded at most once per batch
+        track, freq, time, height, width = batch
+        for t in np.unique(track):
+            feature = features[t]
+            label = labels[t]
+            for i in np.flatnonzero(track == t):
+                f = freq[i]
+                s = time[i]
+                out_features[i] = feature[f: f + height, s: s + width]
+                out_labels[i] = label[f: f + height, s: s + width]
+        return
+    assemble(features, batch, out_features)
+    assemble(labels, batch, out_labels)
+
+
+def get_shapes(tracks):
+    # the shapes of lazily loaded tracks come from the manifest
+    if isinstance(tracks, LazyTracks):
+        return tracks.shapes
+    return [track.shape for track in tracks]
+
+
+def take(data, indices, out):
+    """
+    Copy the slices at `indices` into the preallocated `out`
+
+    `data` is an array or a SliceIndex of slices.
+    """
+    if isinstance(data, SliceIndex):
+        return data.gather(indices, out=out)
+    if data.dtype != out.dtype:
+        out[...] = data[indices]
+        return out
+    # the default mode "raise" buffers the output
+    return np.take(data, indices, axis=0, out=out, mode="clip")
+
+
+def produce(features, labels, combine, slots, jobs, ready):
+    # runs in the forked batch workers
+    while True:
+        slot, batch = jobs.get()
+        combine(features, labels, batch, slots[0][slot], slots[1][slot])
+        ready.put(slot)
+
+
+def shared_empty(shape, dtype):
+    # array in shared memory, which is inherited by forked processes
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buffer = RawArray("b", max(count * dtype.itemsize, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+def share(data):
+    # copy of the slices or tracks in shared memory, the tracks of lists
+    # are replaced one by one, so only one track is kept twice at a time
+    if isinstance(data, SliceIndex):
+        share(data.tracks)
+        return data
+    if isinstance(data, list):
+        for i, track in enumerate(data):
+            data[i] = share(track)
+        return data
+    data = np.asarray(data)
+    shared = shared_empty(data.shape, data.dtype)
+    shared[...] = data
+    return shared
@@ -6,15 +6,31 @@ Provides checkpoint hooks to be used by keras
 
 """
 
+import csv
 import datetime
-from keras.callbacks import ModelCheckpoint, TensorBoard, \
-    Callback, EarlyStopping
+from hashlib import md5
+import json
+import queue
+import resource
+import threading
+import time
+from math import ceil
+import keras
+from keras.callbacks import TensorBoard, Callback, EarlyStopping
+import keras.backend as K
 from matplotlib.cm import get_cmap
+import h5py
 from PIL import Image
 import numpy as np
 import os
+import sys
 
+import console
+import conversion
 from config import config
+from chopper import Chopper
+from loss import Loss
+from metrics import Metrics
 
 
 class Checkpointer(object):
@@ -24,10 +40,13 @@ class Checkpointer(object):
         self.bot = bot
 
     def get(self):
-        if not self.checkpoints:
+        if not self.checkpoints and self.config.validation != "tracks":
             return []
-        names = self.checkpoints.split(",")
+        names = [name for name in self.checkpoints.split(",") if name]
         checkpoints = []
+        # the validation has to run before the checkpoints using it
+        if self.config.validation == "tracks":
+            checkpoints.append(TrackValidation(self.bot))
         for name in names:
             checkpoints.append(getattr(self, name.strip())())
         return checkpoints
@@ -50,17 +69,18 @@ class Checkpointer(object):
                            batch_size=self.config.batch)
 
     def weights(self):
-        filepath = os.path.join(os.path.dirname(self.config.weights),
-                                "best_weights.hdf5")
-        if not os.path.isabs(filepath):
-            filepath = os.path.join(self.config.logs, filepath)
-        return ModelCheckpoint(filepath=filepath,
-                               verbose=1,
-                               save_best_only=True)
+        directory = os.path.join(os.path.dirname(self.config.weights),
+                                 "checkpoints")
+        if not os.path.isabs(directory):
+            directory = os.path.join(self.config.logs, directory)
+        return WeightsCheckpoint(directory)
 
     def error_visualization(self):
         return ErrorVisualization(self.bot)
 
+    def throughput(self):
+        return Throughput(self.bot)
+
     def early_stopping(self):
         params = eval(self.config.early_stopping)
         return EarlyStopping(min_delta=params['min_delta'],
@@ -68,27 +88,178 @@ class Checkpointer(object):
                              verbose=1)
 
 
+class WeightsCheckpoint(Callback):
+    """
+    Weights of the model written by a background thread
+
+    At the end of every epoch the weights are copied from the model and
+    written in the keras format to weights_<epoch>.h5 in the directory
+    by a background thread, first to a temporary file which is renamed
+    when complete. Only the `last` most recent and the `best` best
+    checkpoints by `monitor` are kept, manifest.json lists them
+    with the metrics of their epoch.
+    """
+    def __init__(self, directory):
+        super().__init__()
+        params = eval(config.weights_checkpoint)
+        self.last = params["last"]
+        self.best = params["best"]
+        self.monitor = params.get("monitor", "val_loss")
+        self.mode = params.get("mode", "min")
+        self.directory = directory
+        self.entries = []
+        # at most two snapshots wait for the writer
+        self.jobs = queue.Queue(maxsize=2)
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.writer = threading.Thread(target=self._work, daemon=True)
+        self.writer.start()
+
+    def on_train_end(self, logs=None):
+        # wait for the checkpoints of the last epochs
+        self.jobs.put(None)
+        self.writer.join()
+
+    def on_epoch_end(self, epoch, logs=None):
+        metrics = {name: float(value)
+                   for name, value in (logs or {}).items()}
+        entry = {"file": "weights_%03d.h5" % (epoch + 1),
+                 "epoch": epoch + 1, "metrics": metrics}
+        keep = self._keep(self.entries + [entry])
+        if entry not in keep:
+            return
+        removed = [old["file"] for old in self.entries if old not in keep]
+        self.entries = keep
+        best = self._best(keep)
+        if best and best[0] is entry:
+            console.info("Epoch %d: best %s %.5f" % (
+                epoch + 1, self.monitor, metrics[self.monitor]))
+
+        # copy of the weights of every layer in the order of keras
+        layers = self.model.layers
+        values = iter(K.batch_get_value(
+            [weight for layer in layers for weight in layer.weights]))
+        weights = [(layer.name,
+                    [(weight.name, next(values)) for weight in layer.weights])
+                   for layer in layers]
+        manifest = {"monitor": self.monitor, "mode": self.mode,
+                    "best": [entry["file"] for entry in best],
+                    "checkpoints": keep}
+        self.jobs.put((entry["file"], weights, removed, manifest))
+
+    def _best(self, entries):
+        scored = [entry for entry in entries
+                  if self.monitor in entry["metrics"]]
+        sign = 1 if self.mode == "min" else -1
+        scored.sort(key=lambda entry: sign * entry["metrics"][self.monitor])
+        return scored[:self.best]
+
+    def _keep(self, entries):
+        last = entries[-self.last:] if self.last else []
+        best = self._best(entries)
+        return [entry for entry in entries if entry in last or entry in best]
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            name, weights, removed, manifest = job
+            try:
+                path = os.path.join(self.directory, name)
+                self._save(path + ".tmp", weights)
+                os.replace(path + ".tmp", path)
+                for name in removed:
+                    path = os.path.join(self.directory, name)
+                    if os.path.exists(path):
+                        os.remove(path)
+                path = os.path.join(self.directory, "manifest.json")
+                with open(path + ".tmp", "w") as f:
+                    json.dump(manifest, f, indent=2)
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                console.warn("Writing the checkpoint failed:", e)
+
+    def _save(self, path, weights):
+        # the layout of Model.save_weights, readable by Model.load_weights
+        with h5py.File(path, "w") as f:
+            f.attrs["layer_names"] = [name.encode("utf8")
+                                      for name, _ in weights]
+            f.attrs["backend"] = K.backend().encode("utf8")
+            f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+            for layer, values in weights:
+                group = f.create_group(layer)
+                group.attrs["weight_names"] = [name.encode("utf8")
+                                               for name, _ in values]
+                for name, value in values:
+                    group.create_dataset(name, data=value)
+
+
 class ErrorVisualization(Callback):
+    """
+    Images of the mean squared error of every bin of the validation slices
+
+    The error is computed on a random subset of the validation slices,
+    which stays the same for all epochs. The images are rendered and
+    written by a background thread while the training goes on.
+    """
     def __init__(self, bot):
+        super().__init__()
         self.bot = bot
+        params = eval(config.error_visualization)
+        self.batch_size = params["batch_size"]
+        y_valid = self.bot.y_valid
+        rng = np.random.default_rng(config.get_seed())
+        size = min(params["slices"], len(y_valid))
+        # sorted for sequential reads of memory-mapped validation slices
+        self.indices = np.sort(rng.choice(len(y_valid), size,
+                                          replace=False))
+        self.error = np.zeros(y_valid[0].shape, dtype=np.float32)
+        self.images = queue.Queue()
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def on_train_end(self, logs=None):
+        # wait for the images of the last epochs
+        self.images.put(None)
+        self.writer.join()
 
-    def on_epoch_end(self, epoch, logs={}):
+    def on_epoch_end(self, epoch, logs=None):
         x_valid = self.bot.x_valid
         y_valid = self.bot.y_valid
 
-        error = np.zeros(y_valid[0].shape)
+        self.error.fill(0)
+        for start in range(0, len(self.indices), self.batch_size):
+            batch = self.indices[start:start + self.batch_size]
+            y_pred = self.bot.model.predict(x_valid[batch],
+                                            batch_size=self.batch_size)
+            y_pred = np.subtract(y_pred, y_valid[batch], dtype=np.float32)
+            np.square(y_pred, out=y_pred)
+            self.error += np.sum(y_pred, axis=0)
+        self.error /= len(self.indices)
 
-        n = len(x_valid) // 100
-        for i in range(n):
-            y_pred = self.bot.model.predict(x_valid[i*100:(i+1)*100],
-                                            batch_size=8)
-            error += np.sum(np.square(y_pred - y_valid[i*100:(i+1)*100]),
-                            axis=0)
+        console.info("Error of", len(self.indices), "validation slices:",
+                     "mean", np.mean(self.error), "max", np.max(self.error))
+        # the buffer is reused in the next epoch
+        self.images.put((epoch, self.error.copy()))
 
-        error /= (100*n)
-        print(np.mean(error))
-        print(np.max(error))
-        all_error = error
+    def _write(self):
+        while True:
+            item = self.images.get()
+            if item is None:
+                return
+            try:
+                self._render(*item)
+            except Exception as e:
+                console.warn("Error visualization failed:", e)
+
+    def _render(self, epoch, all_error):
         if self.bot.config.learn_phase:
             parts = ["real", "imag"]
         else:
@@ -112,3 +283,324 @@ class ErrorVisualization(Callback):
             im.save("%s/error%03d-%s-%f.png"
                     % (image_path, epoch, part, top_val),
                     format='PNG')
+
+
+class TrackValidation(Callback):
+    """
+    Validation on the whole tracks instead of overlapping slices
+
+    Every validation track is predicted once in time tiles
+    of INFERENCE_SLICE frames, which overlap the neighbouring tiles
+    by VALIDATION_MARGIN frames for the receptive field of the model.
+    Loss and metrics of the model are computed on each whole track,
+    averaged over the frames of all tracks and added to the logs
+    as val_* keys. The prepared tracks are kept for the next epochs.
+    """
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+        self.config = config
+        metrics = Metrics().get()
+        self.names = ["loss"] + [metric.__name__ for metric in metrics]
+        y_true = K.placeholder(ndim=4)
+        y_pred = K.placeholder(ndim=4)
+        self.evaluate = K.function(
+            [y_true, y_pred],
+            [K.mean(function(y_true, y_pred))
+             for function in [Loss().get()] + metrics])
+        self.tracks = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None:
+            logs = {}
+        if self.tracks is None:
+            self.tracks = self.prepare()
+        totals = np.zeros(len(self.names))
+        frames = 0
+        for mashup, output in self.tracks:
+            prediction = self.predict(mashup)
+            values = self.evaluate([output[np.newaxis],
+                                    prediction[np.newaxis]])
+            totals += np.array(values) * output.shape[1]
+            frames += output.shape[1]
+
+        results = []
+        for name, total in zip(self.names, totals):
+            logs["val_" + name] = total / frames
+            results.append("val_%s: %.4f" % (name, total / frames))
+        console.info("Validation on", len(self.tracks),
+                     "tracks -", " - ".join(results))
+
+    def prepare(self):
+        data = self.bot.data
+        tracks = []
+        for track in data.validation_tracks:
+            mashup, output = data.prepare_track(track)
+            # the same frequencies as the validation slices
+            freq, height = Chopper()._full_rows(mashup, False)
+            tracks.append((mashup[freq: freq + height],
+                           output[freq: freq + height]))
+        return tracks
+
+    def predict(self, mashup):
+        grid = self.bot.peakDownscaleFactor
+        channels = self.config.get_channels()
+        # tile borders on the grid give the same result as the whole track
+        width = max(self.config.inference_slice // grid * grid, grid)
+        margin = ceil(self.config.validation_margin / grid) * grid
+        frames = mashup.shape[1]
+        prediction = np.empty(mashup.shape[:2] + (channels,),
+                              dtype=mashup.dtype)
+        for start in range(0, frames, width):
+            end = min(start + width, frames)
+            first = max(start - margin, 0)
+            last = min(end + margin, frames)
+            tile = conversion.expand_to_grid(mashup[:, first:last],
+                                             grid, channels)
+            predicted = self.bot.model.predict(tile[np.newaxis])[0]
+            prediction[:, start:end] = \
+                predicted[:mashup.shape[0], start - first:end - first]
+        return prediction
+
+
+class Throughput(Callback):
+    """
+    Records where the training time goes
+
+    Every THROUGHPUT_INTERVAL steps and at the end of every epoch
+    the samples per second, the time per train step, the time the
+    training loop waited for the next batch, the time the batch
+    generator waited (see Batch) and the resident memory of the process
+    are appended to throughput.csv in the log directory and written
+    to tensorboard. A run is bound by the input pipeline
+    when the input wait makes up a large part of the time.
+    """
+    fields = ["samples_per_second", "step_time", "input_wait",
+              "generator_wait", "rss_mb"]
+
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+        self.config = config
+        self.interval = self.config.throughput_interval
+        self.path = os.path.join(self.config.logs, "throughput.csv")
+        self.log_dir = os.path.join(self.config.logs,
+                                    self.config.tensorboard, "throughput")
+        self.writer = None
+        self.step = 0
+
+    def on_train_begin(self, logs=None):
+        import tensorflow as tf
+        if hasattr(tf.summary, "create_file_writer") \
+                and tf.executing_eagerly():
+            writer = tf.summary.create_file_writer(self.log_dir)
+
+            def write(tag, value, step):
+                with writer.as_default():
+                    tf.summary.scalar(tag, value, step=step)
+            self.writer = write
+        else:
+            writer = tf.compat.v1.summary.FileWriter(self.log_dir)
+
+            def write(tag, value, step):
+                summary = tf.compat.v1.Summary(value=[
+                    tf.compat.v1.Summary.Value(tag=tag, simple_value=value)])
+                writer.add_summary(summary, step)
+                writer.flush()
+            self.writer = write
+        if not os.path.exists(self.path):
+            with open(self.path, "w", newline="") as file:
+                csv.writer(file).writerow(["epoch", "step", "scope"]
+                                          + self.fields)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_number = epoch
+        self.epoch = self._start()
+        self.interval_totals = self._start()
+        self.batch_end = None
+
+    def on_batch_begin(self, batch, logs=None):
+        now = time.time()
+        # the time since the last step was spent getting the batch
+        if self.batch_end is not None:
+            for totals in [self.epoch, self.interval_totals]:
+                totals["input_wait"] += now - self.batch_end
+        self.batch_begin = now
+
+    def on_batch_end(self, batch, logs=None):
+        now = time.time()
+        size = (logs or {}).get("size", self.config.batch)
+        for totals in [self.epoch, self.interval_totals]:
+            totals["step_time"] += now - self.batch_begin
+            totals["samples"] += size
+            totals["steps"] += 1
+        self.batch_end = now
+        self.step += 1
+        if self.step % self.interval == 0:
+            self._record(self.interval_totals, "interval")
+            self.interval_totals = self._start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        values = self._record(self.epoch, "epoch")
+        console.info("Throughput: %.1f samples/s, %.1f ms per step, "
+                     "%.1f ms input wait per step, %.0f MB"
+                     % (values["samples_per_second"],
+                        1000 * values["step_time"],
+                        1000 * values["input_wait"], values["rss_mb"]))
+
+    def _start(self):
+        return {"start": time.time(), "generator": self._generator_wait(),
+                "samples": 0, "steps": 0,
+                "step_time": 0.0, "input_wait": 0.0}
+
+    def _record(self, totals, scope):
+        elapsed = time.time() - totals["start"]
+        steps = max(totals["steps"], 1)
+        values = {
+            "samples_per_second": totals["samples"] / max(elapsed, 1e-9),
+            "step_time": totals["step_time"] / steps,
+            "input_wait": totals["input_wait"] / steps,
+            "generator_wait":
+                (self._generator_wait() - totals["generator"]) / steps,
+            "rss_mb": _rss() / 2**20,
+        }
+        with open(self.path, "a", newline="") as file:
+            csv.writer(file).writerow([self.epoch_number, self.step, scope]
+                                      + [values[name]
+                                         for name in self.fields])
+        for name in self.fields:
+            self.writer("throughput/%s_%s" % (scope, name),
+                        values[name], self.step)
+        return values
+
+    def _generator_wait(self):
+        batches = getattr(self.bot, "batches", None)
+        return batches.wait if batches is not None else 0.0
+
+
+class TrainingState(Callback):
+    """
+    Bundle of everything needed to continue an interrupted training
+
+    The weights of the model and the optimizer, the epoch, the step
+    in the epoch, the number of batches drawn from the batch generator
+    and the seed of the batch generator are written to STATE in the log
+    directory of the run after the step in which the training was
+    interrupted and, if STATE_STEPS is set, every STATE_STEPS steps.
+    The bundle is written to a temporary file and renamed, so an
+    interruption while saving keeps the last bundle.
+    """
+    def __init__(self, bot, epoch_steps):
+        super().__init__()
+        self.bot = bot
+        self.config = config
+        self.path = self.config.state
+        if not os.path.isabs(self.path):
+            self.path = os.path.join(self.config.logs, self.path)
+        self.epoch_steps = epoch_steps
+        self.epoch = 0
+        self.step = 0
+        self.batches = 0
+        self.training = False
+        # number of the signal to stop the training after the current step
+        self.interrupted = None
+        # callbacks of the training, ended before the exit
+        self.callbacks = []
+
+    def load(self, path):
+        if not os.path.isabs(path):
+            path = os.path.join(self.config.log_base, path)
+        model = self.bot.model
+        with h5py.File(path, "r") as f:
+            if f.attrs.get("key") != self.get_key():
+                raise ValueError("The training state %s was saved with "
+                                 "another configuration or model" % path)
+            model.set_weights(self._read(f["model"]))
+            # the weights of the optimizer are created with the train function
+            model._make_train_function()
+            model.optimizer.set_weights(self._read(f["optimizer"]))
+            self.epoch = int(f.attrs["epoch"])
+            self.step = int(f.attrs["step"])
+            self.batches = int(f.attrs["batches"])
+            self.config.set("seed", str(f.attrs["seed"]))
+        console.info("Resuming epoch", self.epoch + 1, "at step", self.step,
+                     "from", path)
+
+    def save(self):
+        model = self.bot.model
+        temp = self.path + ".tmp"
+        with h5py.File(temp, "w") as f:
+            self._write(f.create_group("model"), model.get_weights())
+            self._write(f.create_group("optimizer"),
+                        model.optimizer.get_weights())
+            f.attrs["epoch"] = self.epoch
+            f.attrs["step"] = self.step
+            f.attrs["batches"] = self.batches
+            f.attrs["seed"] = self.config.get_seed()
+            f.attrs["key"] = self.get_key()
+        os.replace(temp, self.path)
+
+    def get_key(self):
+        # the weights, the steps and the batch stream have to fit the run
+        shapes = [K.int_shape(weight) for weight in self.bot.model.weights]
+        settings = str([self.config.get_character(), self.config.chopparams,
+                        self.config.fft, self.config.batch,
+                        self.epoch_steps, shapes])
+        return md5(settings.encode()).hexdigest()
+
+    def on_train_begin(self, logs=None):
+        self.training = True
+
+    def on_train_end(self, logs=None):
+        self.training = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        self.step += 1
+        self.batches += 1
+        if self.step >= self.epoch_steps:
+            # the next epoch starts with the validation of this one
+            return
+        if self.interrupted is not None:
+            self._stop()
+        if self.config.state_steps \
+                and self.batches % self.config.state_steps == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        self.step = 0
+        if self.interrupted is not None:
+            self._stop()
+        if self.config.state_steps:
+            self.save()
+
+    def _stop(self):
+        self.save()
+        console.warn("Saved the training state to", self.path)
+        # keras does not end the callbacks when the training exits,
+        # the writer threads still have to finish their queued files
+        for callback in self.callbacks:
+            if callback is not self:
+                callback.on_train_end()
+        # 128 + signal is the exit code of a process killed by the signal
+        sys.exit(128 + self.interrupted)
+
+    def _read(self, group):
+        return [group[str(i)][()] for i in range(len(group))]
+
+    def _write(self, group, weights):
+        for i, weight in enumerate(weights):
+            group.create_dataset(str(i), data=weight)
+
+
+def _rss():
+    # resident memory of the process in bytes
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak instead of current memory without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -3,7 +3,7 @@ from hashlib import md5
 from config import config
 from inspect import signature
 import numpy as np
-import random
+from numpy.lib.stride_tricks import as_strided
 
 
 class Chopper(object):
@@ -11,6 +11,10 @@ class Chopper(object):
         self.config = config
         self.name = self.config.chopname
         self.params = self.config.chopparams
+        # return a SliceIndex instead of a list of slices
+        self.index = self.config.slice_index
+        # stream of the random choppers
+        self.rng = np.random.default_rng(self.config.get_seed())
 
     def get(self, both=True):
         function = getattr(self, self.name)
@@ -26,21 +30,43 @@ class Chopper(object):
                     vocal_slices = function(vocal, **params)
                     return mashup_slices, vocal_slices
             else:
-                def chop_both(mashup, vocal):
-                    return function(mashup, vocal, **params)
+                # keyword arguments like a precomputed energy
+                # are passed on to the chopper
+                def chop_both(mashup, vocal, **kwargs):
+                    return function(mashup, vocal, **params, **kwargs)
             return chop_both
         else:
             def chop(matrix):
                 return function(matrix, **params)
             return chop
 
+    def get_energy(self):
+        """
+        Returns a name identifying the energy used by the chopper
+        and a function computing it from the vocal
+        or None if the chopper does not use the energy
+        """
+        if self.name not in ["filtered", "filtered_full"]:
+            return None
+        params = eval(self.params)
+
+        def energy(vocal):
+            return self.energy(vocal, **params)
+        name = "energy_%s_%s_%s" % (params["scale"],
+                                    params.get("upper", False),
+                                    params.get("filter", "mean"))
+        return name, energy
+
     def get_all_chop_names(self):
         def filter_name(name):
             return not (name.startswith('_')
                         or name.startswith('get')
                         or name == 'config'
                         or name == 'params'
-                        or name == 'name')
+                        or name == 'name'
+                        or name == 'index'
+                        or name == 'rng'
+                        or name == 'energy')
 
         return [name for name in dir(self) if filter_name(name)]
 
@@ -53,26 +79,14 @@ class Chopper(object):
     # so the neural net gets a consistent size for training
     # (doesn't matter for inference)
     def tile(self, matrix, scale, upper=False, **kwargs):
-        slices = []
         limit = matrix.shape[0]//2 if upper else matrix.shape[0]
-
-        for time in range(0, matrix.shape[1] // scale):
-            for freq in range(0, limit // scale):
-                s = matrix[freq * scale: (freq + 1) * scale,
-                           time * scale: (time + 1) * scale, :]
-                slices.append(s)
-        return slices
+        freq, time = self._grid(limit // scale, scale,
+                                matrix.shape[1] // scale, scale)
+        return self._slices(matrix, freq, time, scale, scale)
 
     def full(self, matrix, scale, upper=False, **kwargs):
-        slices = []
-        for time in range(0, matrix.shape[1] // scale):
-            if upper:
-                s = matrix[0:matrix.shape[0]//2,
-                           time * scale: (time + 1) * scale, :]
-            else:
-                s = matrix[1:, time * scale: (time + 1) * scale, :]
-            slices.append(s)
-        return slices
+        time = np.arange(matrix.shape[1] // scale) * scale
+        return self._full_slices(matrix, time, scale, upper)
 
     def sliding(self, matrix, scale, step, upper=False, **kwargs):
         if isinstance(step, int):
@@ -81,135 +95,96 @@ class Chopper(object):
         else:
             time_step = step[0]
             freq_step = step[1]
-        slices = []
         limit = matrix.shape[0] // 2 if upper else matrix.shape[0]
-
-        for time in range(0, (matrix.shape[1] - scale) // time_step):
-            for freq in range(0, (limit - scale) // freq_step):
-                s = matrix[freq * freq_step: freq * freq_step + scale,
-                           time * time_step: time * time_step + scale, :]
-                slices.append(s)
-        return slices
+        freq, time = self._grid((limit - scale) // freq_step, freq_step,
+                                (matrix.shape[1] - scale) // time_step,
+                                time_step)
+        return self._slices(matrix, freq, time, scale, scale)
 
     def sliding_full(self, matrix, scale, step, upper=False, **kwargs):
         if isinstance(step, int):
             time_step = step
         else:
             time_step = step[0]
-        slices = []
-
-        for time in range(0, (matrix.shape[1] - scale) // time_step):
-            if upper:
-                s = matrix[0:matrix.shape[0] // 2,
-                           time * time_step: time * time_step + scale, :]
-            else:
-                s = matrix[1:, time * time_step: time * time_step + scale, :]
-            slices.append(s)
-        return slices
-
-    def filtered(self, mashup, vocal, scale,
-                 upper=False, filter="mean", **kwargs):
-
-        filter_function = getattr(self, "_" + filter)
-
-        mashup_slices = []
-        vocal_slices = []
-
+        time = np.arange((matrix.shape[1] - scale) // time_step) * time_step
+        return self._full_slices(matrix, time, scale, upper)
+
+    def energy(self, vocal, scale, upper=False, filter="mean", **kwargs):
+        """
+        Energy of the vocal used by the filtered choppers
+
+        Returns the mean over all tiles and the filter value
+        of every tile and of every full height column,
+        each computed in a single reduction over the reshaped vocal.
+        """
+        reduce = getattr(self, "_" + filter)
+        vocal = np.asarray(vocal)
         limit = vocal.shape[0] // 2 if upper else vocal.shape[0]
+        n_freq = limit // scale
+        n_time = vocal.shape[1] // scale
 
-        slices = self.tile(vocal, scale, upper)
-        mean_deviation = np.sum(slices) / \
-            (len(slices) * np.prod(slices[0].shape))
-
-        for time in range(0, vocal.shape[1] // scale):
-            for freq in range(0, limit // scale):
-                sa = vocal[freq * scale: (freq + 1) * scale,
-                           time * scale: (time + 1) * scale, :]
+        tiles = vocal[:n_freq * scale, :n_time * scale, :]
+        tiles = tiles.reshape(n_freq, scale, n_time, scale, -1)
+        mean_deviation = np.mean(tiles)
 
-                sm = mashup[freq * scale: (freq + 1) * scale,
-                            time * scale: (time + 1) * scale, :]
+        freq, height = self._full_rows(vocal, upper)
+        columns = vocal[freq: freq + height, :n_time * scale, :]
+        columns = columns.reshape(height, n_time, scale, -1)
 
-                if mean_deviation < filter_function(sa):
-                    vocal_slices.append(sa)
-                    mashup_slices.append(sm)
+        return mean_deviation, reduce(tiles, axis=(1, 3, 4)), \
+            reduce(columns, axis=(0, 2, 3))
 
-        return mashup_slices, vocal_slices
-
-    def filtered_full(self, mashup, vocal, scale,
-                      upper=False, filter="mean", **kwargs):
+    def filtered(self, mashup, vocal, scale,
+                 upper=False, filter="mean", energy=None, **kwargs):
 
-        filter_function = getattr(self, "_" + filter)
+        if energy is None:
+            energy = self.energy(vocal, scale, upper, filter)
+        mean_deviation, tiles, _ = energy
 
-        mashup_slices = []
-        vocal_slices = []
+        freq, time = self._grid(tiles.shape[0], scale, tiles.shape[1], scale)
+        # tiles are ordered by time first
+        keep = (mean_deviation < tiles).T.ravel()
+        freq = freq[keep]
+        time = time[keep]
 
-        slices = self.tile(vocal, scale, upper)
-        mean_deviation = np.sum(slices) / \
-            (len(slices) * np.prod(slices[0].shape))
+        return self._slices(mashup, freq, time, scale, scale), \
+            self._slices(vocal, freq, time, scale, scale)
 
-        for time in range(0, vocal.shape[1] // scale):
-            if upper:
-                sa = vocal[0:vocal.shape[0] // 2,
-                           time * scale: (time + 1) * scale, :]
+    def filtered_full(self, mashup, vocal, scale,
+                      upper=False, filter="mean", energy=None, **kwargs):
 
-                sm = mashup[0:mashup.shape[0] // 2,
-                            time * scale: (time + 1) * scale, :]
-            else:
-                sa = vocal[1:, time * scale: (time + 1) * scale, :]
-                sm = mashup[1:, time * scale: (time + 1) * scale, :]
+        if energy is None:
+            energy = self.energy(vocal, scale, upper, filter)
+        mean_deviation, _, columns = energy
 
-            if mean_deviation < filter_function(sa):
-                vocal_slices.append(sa)
-                mashup_slices.append(sm)
+        time = np.arange(len(columns)) * scale
+        time = time[mean_deviation < columns]
 
-        return mashup_slices, vocal_slices
+        return self._full_slices(mashup, time, scale, upper), \
+            self._full_slices(vocal, time, scale, upper)
 
     def random(self, mashup, vocal, scale, slices,
-               upper=False, **kwargs):
-
-        mashup_slices = []
-        vocal_slices = []
+               upper=False, rng=None, **kwargs):
+        if rng is None:
+            rng = self.rng
 
         limit = vocal.shape[0] // 2 if upper else vocal.shape[0]
 
-        for i in range(0, slices):
-            random_time = random.randrange(vocal.shape[1] - scale)
-            random_freq = random.randrange(limit - scale)
-
-            sa = vocal[random_freq: random_freq + scale,
-                       random_time: random_time + scale, :]
+        time = rng.integers(vocal.shape[1] - scale, size=slices)
+        freq = rng.integers(limit - scale, size=slices)
 
-            sm = mashup[random_freq: random_freq + scale,
-                        random_time: random_time + scale, :]
-
-            vocal_slices.append(sa)
-            mashup_slices.append(sm)
-
-        return mashup_slices, vocal_slices
+        return self._slices(mashup, freq, time, scale, scale), \
+            self._slices(vocal, freq, time, scale, scale)
 
     def random_full(self, mashup, vocal, scale, slices,
-                    upper=False, **kwargs):
-
-        mashup_slices = []
-        vocal_slices = []
+                    upper=False, rng=None, **kwargs):
+        if rng is None:
+            rng = self.rng
 
-        for i in range(0, slices):
-            random_time = random.randrange(vocal.shape[1] - scale)
+        time = rng.integers(vocal.shape[1] - scale, size=slices)
 
-            if upper:
-                sa = vocal[0:vocal.shape[0] // 2,
-                           random_time: random_time + scale, :]
-
-                sm = mashup[0:mashup.shape[0] // 2,
-                            random_time: random_time + scale, :]
-            else:
-                sa = vocal[1:, random_time: random_time + scale, :]
-                sm = mashup[1:, random_time: random_time + scale, :]
-
-            vocal_slices.append(sa)
-            mashup_slices.append(sm)
-
-        return mashup_slices, vocal_slices
+        return self._full_slices(mashup, time, scale, upper), \
+            self._full_slices(vocal, time, scale, upper)
 
     def infer(self, matrix, scale, **kwargs):
         slices = []
@@ -218,8 +193,123 @@ class Chopper(object):
             slices.append(s)
         return slices
 
-    def _maximum(self, s):
-            return np.max(s)
-
-    def _mean(self, s):
-            return np.sum(s) / np.prod(s.shape)
+    def _grid(self, n_freq, freq_step, n_time, time_step):
+        # offsets of all slices on a grid, ordered by time first
+        time, freq = np.meshgrid(np.arange(n_time) * time_step,
+                                 np.arange(n_freq) * freq_step,
+                                 indexing="ij")
+        return freq.ravel(), time.ravel()
+
+    def _full_rows(self, matrix, upper):
+        # first row and height of the slices covering all frequencies
+        if upper:
+            return 0, matrix.shape[0] // 2
+        else:
+            return 1, matrix.shape[0] - 1
+
+    def _full_slices(self, matrix, time, scale, upper):
+        freq, height = self._full_rows(matrix, upper)
+        freq = np.full(len(time), freq, dtype=np.int32)
+        return self._slices(matrix, freq, time, height, scale)
+
+    def _slices(self, matrix, freq, time, height, width):
+        if self.index:
+            return SliceIndex([matrix], np.zeros(len(freq)),
+                              freq, time, height, width)
+        if len(freq) == 0:
+            return np.empty((0, height, width, matrix.shape[2]),
+                            dtype=matrix.dtype)
+        # one gather from the view of all windows
+        # instead of cutting the slices one by one
+        windows = _windows(np.asarray(matrix), height, width)
+        return windows[np.asarray(freq), np.asarray(time)]
+
+    def _maximum(self, blocks, axis):
+        return np.max(blocks, axis=axis)
+
+    def _mean(self, blocks, axis):
+        return np.mean(blocks, axis=axis)
+
+
+def _windows(matrix, height, width):
+    # read-only view of all height x width windows of the matrix,
+    # indexed by [freq, time, row, column, channel]
+    freq_stride, time_stride, channel_stride = matrix.strides
+    shape = (matrix.shape[0] - height + 1, matrix.shape[1] - width + 1,
+             height, width, matrix.shape[2])
+    strides = (freq_stride, time_stride,
+               freq_stride, time_stride, channel_stride)
+    return as_strided(matrix, shape=shape, strides=strides, writeable=False)
+
+
+class SliceIndex(object):
+    """
+    Slices of equal shape cut from a list of tracks
+
+    Instead of copies only the track number and the frequency and time
+    offset of every slice is stored. It behaves like an array of slices:
+    indexing returns a view of a single slice, `gather` and np.asarray
+    copy the slices into one array.
+    """
+    def __init__(self, tracks, track, freq, time, height, width):
+        self.tracks = tracks
+        self.track = np.asarray(track, dtype=np.int32)
+        self.freq = np.asarray(freq, dtype=np.int32)
+        self.time = np.asarray(time, dtype=np.int32)
+        self.height = height
+        self.width = width
+
+    @staticmethod
+    def concatenate(indices):
+        tracks = []
+        track = []
+        for index in indices:
+            track.append(index.track + len(tracks))
+            tracks.extend(index.tracks)
+        return SliceIndex(tracks, np.concatenate(track),
+                          np.concatenate([index.freq for index in indices]),
+                          np.concatenate([index.time for index in indices]),
+                          indices[0].height, indices[0].width)
+
+    @property
+    def shape(self):
+        return (len(self), self.height, self.width, self.tracks[0].shape[2])
+
+    def __len__(self):
+        return len(self.track)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        f = self.freq[i]
+        t = self.time[i]
+        return self.tracks[self.track[i]][f: f + self.height,
+                                          t: t + self.width, :]
+
+    def gather(self, indices=None, out=None):
+        if indices is None:
+            indices = range(len(self))
+        if out is None:
+            out = np.empty((len(indices),) + self.shape[1:],
+                           dtype=self.tracks[0].dtype)
+        # the slices are copied track by track,
+        # so a lazily loaded track is loaded once
+        indices = np.asarray(indices, dtype=int)
+        track = self.track[indices]
+        current = None
+        for i in np.argsort(track, kind="stable"):
+            if track[i] != current:
+                current = track[i]
+                matrix = self.tracks[current]
+            f = self.freq[indices[i]]
+            t = self.time[indices[i]]
+            out[i] = matrix[f: f + self.height, t: t + self.width, :]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.gather()
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
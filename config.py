@@ -18,8 +18,28 @@ class Config(object):
         self._values = {}
         # Size of FFT windows
         self.fft = self.get_int("FFT", 1536)
+        # Additional FFT sizes to create while creating the spectrograms
+        self.fft_variants = self.get("FFT_VARIANTS", "")
+        # Directory to cache the decoded audio files in
+        self.pcm_cache = self.get("PCM_CACHE", "")
+        # Sample rate the audio files are resampled to
+        self.sample_rate = self.get_int("SAMPLE_RATE", 22050)
+        # Resampler: none (keep sample rate of the file), fast, best
+        self.resampler = self.get("RESAMPLER", "best")
         # Path containing training data
         self.data = self.get("DATA", "../bot_data")
+        # Number of processes creating the spectrograms of the data
+        self.ingest_workers = self.get_int("INGEST_WORKERS", 1)
+        # Format of the cached spectrograms
+        self.storage = self.get("STORAGE", "complex128")
+        # Store the instrumental instead of deriving it as mashup - vocal
+        self.store_instrumental = self.get_bool("STORE_INSTRUMENTAL", True)
+        # Compression of the cached spectrograms
+        self.storage_compression = self.get("STORAGE_COMPRESSION", "")
+        # Cache the converted and normalized tracks next to the data
+        self.prepared_cache = self.get_bool("PREPARED_CACHE", False)
+        # Keep the validation slices in memory-mapped files next to the data
+        self.valid_cache = self.get_bool("VALID_CACHE", False)
         # Proportion of the data to train on
         self.split = self.get_float("SPLIT", 0.9)
         # Number of epochs to train.
@@ -37,10 +57,28 @@ class Config(object):
         # early stopping checkpoint parameters
         self.early_stopping = self.get("EARLY_STOPPING",
                                        "{'min_delta': 0.001, 'patience': 3}")
+        # error visualization checkpoint parameters
+        self.error_visualization = self.get("ERROR_VISUALIZATION",
+                                            "{'slices': 1000, "
+                                            "'batch_size': 64}")
+        # weights checkpoint parameters
+        self.weights_checkpoint = self.get("WEIGHTS_CHECKPOINT",
+                                           "{'last': 2, 'best': 1, "
+                                           "'monitor': 'val_loss', "
+                                           "'mode': 'min'}")
         # Phase iterations for reconstruction
         self.phase_iterations = self.get_int("PHASE_ITERATIONS", 10)
         # Learn phase
         self.learn_phase = self.get_bool("LEARN_PHASE", True)
+        # Floating point type of the prepared spectrograms and batches
+        self.dtype = self.get("DTYPE", "float32")
+
+        # Bundle of the training state, relative to the log dir of the run
+        self.state = self.get("STATE", "state.h5")
+        # Steps between the saves of the training state (0 = only on exit)
+        self.state_steps = self.get_int("STATE_STEPS", 0)
+        # Bundle of the training state to continue, relative to the log base
+        self.resume = self.get("RESUME", "")
 
         # quit after training for specified epochs
         self.quit = self.get_bool("QUIT", True)
@@ -49,6 +87,13 @@ class Config(object):
 
         # The size of the slices for the inference
         self.inference_slice = self.get_int("INFERENCE_SLICE", 3500)
+        # Number of slices predicted together by the inference
+        self.inference_batch = self.get_int("INFERENCE_BATCH", 4)
+
+        # Validate on overlapping slices or on whole tracks
+        self.validation = self.get("VALIDATION", "slices")
+        # Frames the tiles of the track validation overlap
+        self.validation_margin = self.get_int("VALIDATION_MARGIN", 64)
 
         # train on instrumentals
         self.instrumental = self.get_bool("INSTRUMENTAL", False)
@@ -62,11 +107,20 @@ class Config(object):
                                                  "'upper':False, "
                                                  "'filter':'maximum'}")
 
+        # Seed of the random slices and batches (empty for a random seed)
+        self.seed = self.get("SEED", "")
+
+        # Describe slices by their offsets into the tracks
+        # instead of copying them
+        self.slice_index = self.get_bool("SLICE_INDEX", False)
+
         # metrics
         self.metrics = self.get("METRICS", "mean_pred,max_pred")
 
         # Checkpoints run after each epoch
         self.checkpoints = self.get("CHECKPOINTS", "tensorboard,weights")
+        # Steps between the records of the throughput checkpoint
+        self.throughput_interval = self.get_int("THROUGHPUT_INTERVAL", 100)
 
         # model
         self.model = self.get("MODEL", "leaky_dropout")
@@ -79,6 +133,22 @@ class Config(object):
         # batch generator
         self.batch_generator = self.get("BATCH_GENERATOR", "random")
         self.epoch_steps = self.get_int("EPOCH_STEPS", 50000)
+        # Number of processes assembling the batches (0 = training process)
+        self.batch_workers = self.get_int("BATCH_WORKERS", 0)
+        # Number of batches prepared in advance by the batch workers
+        self.batch_queue = self.get_int("BATCH_QUEUE", 4)
+        # Memory budget in MB for prepared tracks kept by the random
+        # batch generators (0 = prepare and keep all tracks in memory)
+        self.track_cache = self.get_int("TRACK_CACHE", 0)
+        # Gain range in dB of the stems, probability to mix stems
+        # of different tracks and normalization (track or slice)
+        # for the remix batch generator
+        self.remix_params = self.get("REMIX_PARAMS",
+                                     "{'gain_db': 6, 'cross_track': 0.5, "
+                                     "'normalize': 'track'}")
+        # Selection of the slices of the random batch generator:
+        # uniform, energy or threshold of the energy of the output
+        self.sampling = self.get("SAMPLING", "uniform")
 
         # loss
         self.loss = self.get("LOSS", "mean_squared_error")
@@ -105,6 +175,12 @@ class Config(object):
         else:
             return 1
 
+    def get_seed(self):
+        if self.seed:
+            return int(self.seed)
+        else:
+            return None
+
     def get_character(self):
         return [self.model, self.instrumental, self.chopname,
                 eval(self.chopparams).get('upper', False),
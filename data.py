@@ -7,21 +7,226 @@ Utility class for data preparation
 """
 import sys
 import os
+import json
+import time
+from hashlib import md5
+from collections import OrderedDict, deque
+from multiprocessing import Pool
 import numpy as np
-import h5py
 
 import console
 import conversion
 from config import config
-from chopper import Chopper
+from chopper import Chopper, SliceIndex
 from normalizer import Normalizer
+from storage import Storage, PreparedStorage, PcmCache
 
 
 def remove_track_boundaries(tracks):
-    slices = []
-    for track in tracks:
-        slices.extend(track)
-    return np.array(slices)
+    if isinstance(tracks, (np.ndarray, SliceIndex)):
+        # the slices of all tracks are already in one array
+        return tracks
+    if len(tracks) == 0:
+        return np.array([])
+    if all(isinstance(track, SliceIndex) for track in tracks):
+        return SliceIndex.concatenate(tracks)
+    # one copy of all slices instead of a list of them
+    return np.concatenate([np.asarray(track) for track in tracks])
+
+
+def create_track_spectrograms(job):
+    # runs in the worker processes of the ingest,
+    # so it has to be a picklable module level function
+    name, files, fft_window_sizes, sample_rate, resampler, pcm_cache = job
+    start = time.time()
+    if pcm_cache:
+        load_audio_file = PcmCache(pcm_cache, sample_rate, resampler).load
+    else:
+        def load_audio_file(file_name):
+            return conversion.load_audio_file(file_name, sample_rate,
+                                              resampler)
+    stfts = {fft_window_size: [] for fft_window_size in fft_window_sizes}
+    for file_name in files:
+        audio, sample_rate = load_audio_file(file_name)
+        for fft_window_size in fft_window_sizes:
+            stfts[fft_window_size].append(
+                conversion.audio_file_to_stft(audio, fft_window_size))
+    return name, stfts, sample_rate, time.time() - start
+
+
+def _imap_bounded(function, jobs, workers):
+    # like Pool.imap, but with at most two pending jobs per worker,
+    # so finished results do not pile up in memory
+    with Pool(workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(function, (job,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+class TrackCache(object):
+    """
+    LRU cache of prepared (mashup, output) track pairs
+
+    Tracks are prepared by `load` on first access and the least recently
+    used tracks are dropped as soon as the cache exceeds `max_bytes`.
+    """
+    def __init__(self, load, max_bytes):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.tracks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, track):
+        if track in self.tracks:
+            self.hits += 1
+            self.tracks.move_to_end(track)
+            return self.tracks[track]
+
+        self.misses += 1
+        value = self.load(track)
+        self.tracks[track] = value
+        self.bytes += self._size(value)
+        # always keep the most recent track
+        while self.bytes > self.max_bytes and len(self.tracks) > 1:
+            _, old = self.tracks.popitem(last=False)
+            self.bytes -= self._size(old)
+        return value
+
+    def _size(self, value):
+        return sum(matrix.nbytes for matrix in value)
+
+    def __str__(self):
+        return "%d hits, %d misses, %d tracks, %.1f MB" \
+            % (self.hits, self.misses, len(self.tracks),
+               self.bytes / 1024**2)
+
+
+class LazyTracks(object):
+    """
+    List-like view on either the mashups (part=0) or the outputs (part=1)
+    of the tracks held by a TrackCache
+
+    The shapes of the tracks are known without loading them.
+    """
+    def __init__(self, cache, tracks, part, shapes):
+        self.cache = cache
+        self.tracks = tracks
+        self.part = part
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getitem__(self, i):
+        return self.cache.get(self.tracks[i])[self.part]
+
+
+class SamplingIndex(object):
+    """
+    Cells of the offsets the random batch generators draw slices from,
+    weighted by the energy of the labels
+
+    The cells lie on a grid with the step of the chopper parameters.
+    The energy of the slice at the start of every cell is computed once
+    from a summed area table of each track, a draw is a search in the
+    cumulative weights followed by a uniform offset within the cell.
+    weighting: energy (proportional to the energy of the slice)
+               or threshold (equal weight for all slices above the mean
+               energy of their track like the filtered chopper)
+    """
+    def __init__(self, chopper, tracks, weighting):
+        params = eval(chopper.params)
+        scale = params["scale"]
+        step = params.get("step", scale)
+        if isinstance(step, int):
+            time_step = step
+            freq_step = step
+        else:
+            time_step = step[0]
+            freq_step = step[1]
+        upper = params.get("upper", False)
+
+        self.width = scale
+        self.freq_step = freq_step
+        self.time_step = time_step
+        self.track = []
+        self.freq = []
+        self.time = []
+        # end of the offsets of every track
+        self.freq_end = []
+        self.time_end = []
+        weights = []
+        for t in range(len(tracks)):
+            track = np.asarray(tracks[t])
+            if "full" in chopper.name:
+                freq, self.height = chopper._full_rows(track, upper)
+                self.freq_end.append(freq + 1)
+                freq = np.array([freq])
+            else:
+                limit = track.shape[0] // 2 if upper else track.shape[0]
+                self.freq_end.append(limit - scale)
+                freq = np.arange(0, limit - scale, freq_step)
+                self.height = scale
+            self.time_end.append(track.shape[1] - scale)
+            time = np.arange(0, track.shape[1] - scale, time_step)
+            energy = self._energy(track, freq, time, self.height, scale)
+            if weighting == "threshold":
+                energy = (energy > np.mean(energy)).astype(np.float64)
+
+            freq, time = np.meshgrid(freq, time, indexing="ij")
+            self.track.append(np.full(freq.size, t, dtype=np.int32))
+            self.freq.append(freq.ravel().astype(np.int32))
+            self.time.append(time.ravel().astype(np.int32))
+            weights.append(energy.ravel())
+
+        self.track = np.concatenate(self.track)
+        self.freq = np.concatenate(self.freq)
+        self.time = np.concatenate(self.time)
+        self.freq_end = np.array(self.freq_end)
+        self.time_end = np.array(self.time_end)
+        self.cumulative = np.cumsum(np.concatenate(weights))
+        self.selected = np.count_nonzero(np.concatenate(weights))
+        if self.cumulative[-1] <= 0:
+            console.warn("Labels have no energy, sampling uniformly")
+            self.cumulative = np.arange(1, len(self.track) + 1,
+                                        dtype=np.float64)
+
+    def _energy(self, track, freq, time, height, width):
+        # sum of the squares of every slice
+        power = np.sum(np.square(track, dtype=np.float64), axis=2)
+        table = np.zeros((power.shape[0] + 1, power.shape[1] + 1))
+        np.cumsum(np.cumsum(power, axis=0), axis=1, out=table[1:, 1:])
+        freq = freq[:, np.newaxis]
+        time = time[np.newaxis, :]
+        return table[freq + height, time + width] \
+            - table[freq, time + width] \
+            - table[freq + height, time] \
+            + table[freq, time]
+
+    def draw(self, n, rng):
+        # track and offsets of n slices,
+        # cells without energy are never drawn
+        k = np.searchsorted(self.cumulative,
+                            rng.random(n) * self.cumulative[-1],
+                            side="right")
+        track = self.track[k]
+        freq = self.freq[k]
+        time = self.time[k]
+        freq_cell = np.minimum(self.freq_step, self.freq_end[track] - freq)
+        time_cell = np.minimum(self.time_step, self.time_end[track] - time)
+        freq = freq + (rng.random(n) * freq_cell).astype(np.int32)
+        time = time + (rng.random(n) * time_cell).astype(np.int32)
+        return track, freq, time
+
+    def __str__(self):
+        return "%d of %d cells from %d tracks" % (
+            self.selected, len(self.track), len(np.unique(self.track)))
 
 
 class Data:
@@ -35,6 +240,13 @@ class Data:
         self.vocal = {}
         self.instrumental = {}
         self.track_names = []
+        self.cache = None
+        self.storage = None
+        self.prepared = None
+        # normalization of the remixed training tracks
+        self.norms = None
+        # energy weighted offsets of the random training slices
+        self.sampling = None
 
         self.load()
         self.split_tracks()
@@ -67,11 +279,42 @@ class Data:
             self.train_tracks = self.track_names[:length]
 
     def train(self):
+        x, y = self.prepare_train()
+        self.sampling = self.get_sampling(x, y)
+        return x, y
+
+    def get_sampling(self, x, y):
+        # built once for all trainings with the data
+        generator = self.config.batch_generator
+        if self.config.sampling == "uniform" \
+                or generator not in ["random", "remix"]:
+            return None
+        # the remix draws the slices of the vocals
+        labels = x if generator == "remix" else y
+        sampling = SamplingIndex(Chopper(), labels, self.config.sampling)
+        console.info("Sampling index:", sampling)
+        return sampling
+
+    def prepare_train(self):
+        if self.config.batch_generator == "remix":
+            if self.config.track_cache:
+                vocals, instrumentals = self.prepare_lazy_data(
+                    self.train_tracks, self.prepare_stems, channels=2)
+                # the norm of a track is cached with its stems
+                self.norms = LazyTracks(self.cache, self.train_tracks, 2,
+                                        vocals.shapes)
+                return vocals, instrumentals
+            stems = [self.prepare_stems(track) for track in self.train_tracks]
+            vocals, instrumentals, self.norms = map(list, zip(*stems))
+            return vocals, instrumentals
         if self.config.batch_generator.startswith("random"):
+            if self.config.track_cache:
+                return self.prepare_lazy_data(self.train_tracks)
             return self.prepare_random_data(self.train_tracks)
         else:
-            chop = Chopper().get()
-            return self.prepare_data(chop, self.train_tracks)
+            chopper = Chopper()
+            return self.prepare_data(chopper.get(), self.train_tracks,
+                                     energy=chopper.get_energy())
 
     def valid(self):
         chopper = Chopper()
@@ -81,141 +324,284 @@ class Data:
         params["step"] = 32
         params["scale"] = 128
         chopper.params = str(params)
+        # validation needs arrays, copy the slices only once
+        chopper.index = True
         chop = chopper.get()
+        if self.config.valid_cache and self.storage is not None \
+                and self.validation_tracks:
+            return self.get_valid_cache(chop, params)
         x_valid, y_valid = self.prepare_data(chop, self.validation_tracks)
         x_valid = remove_track_boundaries(x_valid)
         y_valid = remove_track_boundaries(y_valid)
-        return x_valid, y_valid
-
-    def prepare_data(self, chop, tracks, post_process=False):
-        normalize = Normalizer().get()
-
-        x = []
-        y = []
-        for track in tracks:
-            x.append(self.mashup[track])
-            if self.is_instrumental:
-                y.append(self.instrumental[track])
-            else:
-                y.append(self.vocal[track])
-
-        x = [self.prepare_spectrogram(s) for s in x]
-        y = [self.prepare_spectrogram(s) for s in y]
-
-        x, y = normalize(x, y)
+        return np.asarray(x_valid), np.asarray(y_valid)
+
+    def get_valid_cache(self, chop, params):
+        # slices of the validation tracks in memory-mapped files
+        # next to the data, which depend on these settings,
+        # the prepared key includes the settings of the storage
+        tracks = [self.storage.get_track_info(track)
+                  for track in self.validation_tracks]
+        settings = json.dumps([self.get_prepared_key(), str(params),
+                               self.validation_tracks, tracks],
+                              sort_keys=True)
+        key = md5(settings.encode()).hexdigest()[:12]
+        path = "%s_valid_%s" % (os.path.splitext(self.storage.path)[0], key)
+        paths = [path + "_mashup.npy", path + "_output.npy"]
+        if not all(os.path.exists(path) for path in paths):
+            console.info("Writing validation slices to", path)
+            self.create_valid_cache(chop, paths)
+        return np.load(paths[0], mmap_mode="r"), \
+            np.load(paths[1], mmap_mode="r")
+
+    def create_valid_cache(self, chop, paths):
+        # the number of slices only depends on the shape of the tracks,
+        # so they are counted on arrays without memory
+        counts = []
+        for track in self.validation_tracks:
+            info = self.storage.get_track_info(track)
+            shape = (info["bins"], info["frames"], self.config.get_channels())
+            empty = np.broadcast_to(np.zeros((), self.config.dtype), shape)
+            slices, _ = chop(empty, empty)
+            counts.append(len(slices))
+
+        tmp_paths = ["%s.%d.tmp" % (path, os.getpid()) for path in paths]
+        shape = (sum(counts),) + slices.shape[1:]
+        mashup = np.lib.format.open_memmap(tmp_paths[0], mode="w+",
+                                           dtype=self.config.dtype,
+                                           shape=shape)
+        output = np.lib.format.open_memmap(tmp_paths[1], mode="w+",
+                                           dtype=self.config.dtype,
+                                           shape=shape)
+        # only one prepared track is in memory at a time
+        start = 0
+        for track, count in zip(self.validation_tracks, counts):
+            x, y = chop(*self.prepare_track(track))
+            x.gather(out=mashup[start:start + count])
+            y.gather(out=output[start:start + count])
+            start += count
+        mashup.flush()
+        output.flush()
+        del mashup, output
+        # the mashup is renamed last and marks the files as complete
+        os.replace(tmp_paths[1], paths[1])
+        os.replace(tmp_paths[0], paths[0])
+
+    def prepare_data(self, chop, tracks, post_process=False, energy=None):
+        x, y = self.prepare_random_data(tracks)
 
         mashup_slices = []
         output_slices = []
-        for mashup, output in zip(x, y):
-            x_slices, y_slices = chop(mashup, output)
+        for track, mashup, output in zip(tracks, x, y):
+            if energy is not None:
+                x_slices, y_slices = chop(
+                    mashup, output,
+                    energy=self.get_energy(track, output, *energy))
+            else:
+                x_slices, y_slices = chop(mashup, output)
 
-            x_slices = np.array(x_slices)[:]
-            y_slices = np.array(y_slices)[:]
+            if not isinstance(x_slices, SliceIndex):
+                # the choppers already return one gathered array
+                x_slices = np.asarray(x_slices)
+                y_slices = np.asarray(y_slices)
             mashup_slices.append(x_slices)
             output_slices.append(y_slices)
         return mashup_slices, output_slices
 
-    def prepare_random_data(self, tracks, post_process=False):
-        normalize = Normalizer().get()
+    def prepare_random_data(self, tracks, post_process=False, prepare=None):
+        if prepare is None:
+            prepare = self.prepare_track
         x = []
         y = []
         for track in tracks:
-            x.append(self.mashup[track])
-            if self.is_instrumental:
-                y.append(self.instrumental[track])
-            else:
-                y.append(self.vocal[track])
-
-        x = [self.prepare_spectrogram(s) for s in x]
-        y = [self.prepare_spectrogram(s) for s in y]
-        x, y = normalize(x, y)
+            mashup, output = prepare(track)
+            x.append(mashup)
+            y.append(output)
         return x, y
 
+    def prepare_lazy_data(self, tracks, prepare=None, channels=None):
+        # tracks are read from the h5 file and prepared on demand
+        if prepare is None:
+            prepare = self.prepare_track
+        if channels is None:
+            channels = self.config.get_channels()
+        max_bytes = self.config.track_cache * 1024**2
+        self.cache = TrackCache(prepare, max_bytes)
+        # the batch generators draw the slices from the manifest
+        shapes = []
+        for track in tracks:
+            info = self.storage.get_track_info(track)
+            shapes.append((info["bins"], info["frames"], channels))
+        return LazyTracks(self.cache, tracks, 0, shapes), \
+            LazyTracks(self.cache, tracks, 1, shapes)
+
+    def prepare_track(self, track):
+        prepared = self.get_prepared_storage()
+        if prepared is not None:
+            return prepared.get(track, self.create_prepared_track)
+        return self.create_prepared_track(track)
+
+    def create_prepared_track(self, track):
+        # prepared spectrograms do not share memory with the data,
+        # so they can be normalized in place
+        normalize = Normalizer().get(copy=False)
+        mashup = self.prepare_spectrogram(self.mashup[track])
+        if self.is_instrumental:
+            output = self.prepare_spectrogram(self.instrumental[track])
+        else:
+            output = self.prepare_spectrogram(self.vocal[track])
+        x, y = normalize([mashup], [output])
+        return x[0], y[0]
+
+    def prepare_stems(self, track):
+        # vocal and instrumental as real and imaginary part,
+        # the remix batch generator mixes and normalizes them
+        # with the norm of the unmodified mix like the prepared tracks
+        copy = self.storage is None
+        vocal = conversion.stft_to_real_and_imag(
+            self.vocal[track], self.config.dtype, copy=copy)
+        instrumental = conversion.stft_to_real_and_imag(
+            self.instrumental[track], self.config.dtype, copy=copy)
+        mashup = vocal + instrumental
+        if not self.config.learn_phase:
+            mashup = np.log1p(np.hypot(mashup[..., :1], mashup[..., 1:]))
+        _, norm = Normalizer().get(both=False, copy=False)(mashup)
+        return vocal, instrumental, np.asarray(norm)
+
+    def get_energy(self, track, output, name, energy):
+        # stored next to the prepared track if it is cached
+        prepared = self.get_prepared_storage()
+        if prepared is not None:
+            return prepared.get_energy(track, name,
+                                       lambda: energy(output))
+        return energy(output)
+
+    def get_prepared_key(self):
+        # the prepared tracks depend on these settings,
+        # which can change between the runs of a grid search,
+        # and on the settings of the spectrograms they are prepared from
+        storage = self.storage.get_settings() if self.storage else {}
+        settings = "%s:%s:%s:%s:%s" % (self.config.learn_phase,
+                                       Normalizer().__hash__(),
+                                       self.is_instrumental,
+                                       self.config.dtype,
+                                       json.dumps(storage, sort_keys=True))
+        return md5(settings.encode()).hexdigest()[:12]
+
+    def get_prepared_storage(self):
+        if not self.config.prepared_cache or self.storage is None:
+            return None
+        key = self.get_prepared_key()
+        if self.prepared is None or self.prepared.key != key:
+            self.prepared = PreparedStorage(self.storage, key)
+        return self.prepared
+
     def prepare_spectrogram(self, spectrogram):
         if self.config.learn_phase:
-            return conversion.stft_to_real_and_imag(spectrogram)
+            # stems of the storage are read into new arrays,
+            # which can be viewed and normalized in place
+            return conversion.stft_to_real_and_imag(
+                spectrogram, self.config.dtype,
+                copy=self.storage is None)
         else:
-            return conversion.stft_to_amplitude(spectrogram)
+            return conversion.stft_to_amplitude(spectrogram,
+                                                self.config.dtype)
+
+    def get_data_path(self, fft_window_size=None):
+        if fft_window_size is None:
+            fft_window_size = self.fft_window_size
+        return os.path.join(self.in_path, "data_%s.h5" % fft_window_size)
 
-    def get_data_path(self):
-        return os.path.join(self.in_path, "data_%s.h5" % self.fft_window_size)
+    def get_fft_variants(self):
+        # additional FFT sizes to create from the same decoded audio
+        variants = [int(fft) for fft in self.config.fft_variants.split(",")
+                    if fft.strip()]
+        return [fft for fft in variants if fft != self.fft_window_size]
 
     def load(self, save_data_as_h5=True):
+        tracks = self.find_tracks()
+        if not save_data_as_h5:
+            jobs = [(name, files, [self.fft_window_size])
+                    for name, files in tracks]
+            for name, stfts, _ in self.create_spectrograms(jobs):
+                self.mashup[name], self.vocal[name], \
+                    self.instrumental[name] = stfts[self.fft_window_size]
+                self.track_names.append(name)
+            console.info("Created", len(self.mashup), "total spectras")
+            return
+
+        if self.config.storage == "log_amplitude" and self.config.learn_phase:
+            raise ValueError("STORAGE=log_amplitude has no phase, "
+                             "it needs LEARN_PHASE=False")
+        self.storage = Storage(self.get_data_path(), self.fft_window_size)
+        storages = [self.storage]
+        for fft in self.get_fft_variants():
+            storages.append(Storage(self.get_data_path(fft), fft))
+        self.update_storages(tracks, storages)
+        self.track_names = self.storage.get_track_names()
+
+        h5f = self.storage.open()
+        self.mashup = self.storage.get_stem(h5f, "mashup")
+        self.vocal = self.storage.get_stem(h5f, "vocal")
+        self.instrumental = self.storage.get_stem(h5f, "instrumental")
+
+    def update_storages(self, tracks, storages):
+        # every outdated track is decoded once
+        # for all the storages (FFT sizes) it is missing in
+        jobs = OrderedDict()
+        for storage in storages:
+            for name, files in storage.start_update(tracks):
+                if name not in jobs:
+                    jobs[name] = (name, files, [])
+                jobs[name][2].append(storage)
+        for name, stfts, sample_rate in self.create_spectrograms(
+                [(name, files, [storage.fft_window_size
+                                for storage in track_storages])
+                 for name, files, track_storages in jobs.values()]):
+            for storage in jobs[name][2]:
+                storage.add(name, stfts[storage.fft_window_size],
+                            sample_rate)
+        for storage in storages:
+            storage.finish_update(tracks)
+
+    def find_tracks(self):
         def check_filename(f):
             return (f.endswith(".mp3") or f.endswith("_all.wav")) \
                 and not f.startswith(".")
 
-        h5_path = self.get_data_path()
-        if os.path.isfile(h5_path):
-            h5f = h5py.File(h5_path, "r")
-            mashup = h5f["mashup"]
-            vocal = h5f["vocal"]
-            instrumental = h5f["instrumental"]
-            self.track_names = [name.decode("utf8")
-                                for name in h5f["names"]["track"]]
-            self.mashup = dict(mashup)
-            self.vocal = dict(vocal)
-            self.instrumental = dict(instrumental)
+        tracks = []
+        for dirPath, dirNames, file_names in os.walk(self.in_path):
+            filtered_files = filter(check_filename, file_names)
+            for file_name in filtered_files:
+                name = file_name.replace("_all.wav", "")
+                file_name = os.path.join(self.in_path, file_name)
+                vocal_file = file_name.replace("_all.wav", "_vocal.wav")
+                instrumental_file = file_name.replace("_all.wav",
+                                                      "_instrumental.wav")
+                if not all([os.path.exists(vocal_file),
+                            os.path.exists(instrumental_file)]):
+                    continue
+                tracks.append((name, [file_name, vocal_file,
+                                      instrumental_file]))
+        return tracks
+
+    def create_spectrograms(self, tracks):
+        # yields (name, {fft: (mashup, vocal, instrumental)}, sample_rate)
+        # for every (name, files, ffts) in tracks,
+        # using a process pool if more than one worker is configured
+        jobs = [(name, files, ffts, self.config.sample_rate,
+                 self.config.resampler, self.config.pcm_cache)
+                for name, files, ffts in tracks]
+        workers = self.config.ingest_workers
+        if workers > 1:
+            results = _imap_bounded(create_track_spectrograms, jobs, workers)
         else:
-            for dirPath, dirNames, file_names in os.walk(self.in_path):
-                filtered_files = filter(check_filename, file_names)
-                for file_name in filtered_files:
-                    name = file_name.replace("_all.wav", "")
-                    file_name = os.path.join(self.in_path, file_name)
-                    vocal_file = file_name.replace("_all.wav",
-                                                   "_vocal.wav")
-                    instrumental_file = file_name.replace("_all.wav",
-                                                          "_instrumental.wav")
-                    if not all([os.path.exists(vocal_file),
-                                os.path.exists(instrumental_file)]):
-                        continue
-
-                    audio, sample_rate = conversion.load_audio_file(file_name)
-                    spectrogram = conversion.audio_file_to_stft(
-                        audio, self.fft_window_size)
-                    mashup = spectrogram
-
-                    audio, sample_rate = \
-                        conversion.load_audio_file(vocal_file)
-                    spectrogram = conversion.audio_file_to_stft(
-                        audio, self.fft_window_size)
-                    vocal = spectrogram
-
-                    audio, sample_rate = \
-                        conversion.load_audio_file(instrumental_file)
-                    spectrogram = conversion.audio_file_to_stft(
-                        audio, self.fft_window_size)
-                    instrumental = spectrogram
-
-                    console.info("Created spectrogram for", file_name,
-                                 "with shape",
-                                 spectrogram.shape)
-                    self.mashup[name] = mashup
-                    self.vocal[name] = vocal
-                    self.instrumental[name] = instrumental
-                    self.track_names.append(name)
-            console.info("Created", len(self.mashup), "total spectras")
-            # Save to file
-            if save_data_as_h5:
-                self.save()
-
-    def save(self):
-        h5_path = self.get_data_path()
-        h5f = h5py.File(h5_path, "w")
-        mashup = h5f.create_group("mashup")
-        vocal = h5f.create_group("vocal")
-        instrumental = h5f.create_group("instrumental")
-        names = h5f.create_group("names")
-        track_names = [name.encode("utf8") for name in self.track_names]
-        names.create_dataset(name="track", data=track_names)
-        for track in self.track_names:
-            mashup.create_dataset(name=track.encode("utf8"),
-                                  data=self.mashup[track])
-            vocal.create_dataset(name=track.encode("utf8"),
-                                 data=self.vocal[track])
-            instrumental.create_dataset(name=track.encode("utf8"),
-                                        data=self.instrumental[track])
-        h5f.close()
+            results = map(create_track_spectrograms, jobs)
+        for name, stfts, sample_rate, seconds in results:
+            shapes = [str(stft[0].shape) for stft in stfts.values()]
+            console.info("Created spectrogram for", name,
+                         "with shape", ", ".join(shapes),
+                         "in %.1f s" % seconds)
+            yield name, stfts, sample_rate
 
 
 if __name__ == "__main__":
@@ -7,7 +7,7 @@ Providides normalization functionalities to be used for data preparation
 """
 
 import numpy as np
-import copy
+from copy import deepcopy
 from hashlib import md5
 
 from config import config
@@ -19,16 +19,22 @@ class Normalizer(object):
         self.normalizer = self.config.normalizer
         self.params = self.config.normalizer_params
 
-    def get(self, both=True):
+    def get(self, both=True, copy=True):
         function = getattr(self, self.normalizer)
         if self.params:
             params = eval(self.params)
         else:
             params = {}
+        # without copy the matrices are normalized in place
+        if not copy:
+            def duplicate(matrix):
+                return matrix
+        else:
+            duplicate = deepcopy
         if both:
             def normalize_all(in_mashup, in_vocal):
-                mashup = copy.deepcopy(in_mashup)
-                vocal = copy.deepcopy(in_vocal)
+                mashup = list(duplicate(in_mashup))
+                vocal = list(duplicate(in_vocal))
                 for i in range(len(mashup)):
                     mashup[i], norm = function(mashup[i], **params)
                     vocal[i], _ = function(vocal[i], norm=norm, **params)
@@ -36,14 +42,17 @@ class Normalizer(object):
             return normalize_all
         else:
             def normalize(matrix, norm=None):
-                return function(copy.deepcopy(matrix), norm=norm, **params)
+                return function(duplicate(matrix), norm=norm, **params)
             return normalize
 
-    def get_reverse(self):
+    def get_reverse(self, copy=True):
         function = getattr(self, "reverse_%s" % self.normalizer)
 
+        # without copy the matrix is denormalized in place
         def denormalize(matrix, norm):
-            return function(matrix.copy(), norm)
+            if copy:
+                matrix = matrix.copy()
+            return function(matrix, norm)
         return denormalize
 
     def __hash__(self):
@@ -0,0 +1,393 @@
+#!/usr/bin/python3
+"""
+Storage class
+
+Spectrogram cache of the training data (data_<fft>.h5)
+with a manifest (data_<fft>.json) describing every cached track
+
+"""
+
+import os
+import json
+import glob
+from hashlib import md5
+from collections.abc import Mapping
+import numpy as np
+import h5py
+
+import console
+import conversion
+from config import config
+
+
+class Storage(object):
+    def __init__(self, path, fft_window_size):
+        self.config = config
+        self.path = path
+        self.manifest_path = os.path.splitext(path)[0] + ".json"
+        self.fft_window_size = fft_window_size
+        self.store_instrumental = self.config.store_instrumental
+        if not self.store_instrumental \
+                and self.config.storage == "log_amplitude":
+            console.warn("The instrumental can not be derived without phase,"
+                         " storing it")
+            self.store_instrumental = True
+        self.manifest = self.read_manifest()
+        self.h5f = None
+
+    def get_settings(self):
+        # a cache created with different settings is recreated
+        return {"fft": self.fft_window_size,
+                "sample_rate": self.config.sample_rate,
+                "resampler": self.config.resampler,
+                "format": self.config.storage,
+                "instrumental": self.store_instrumental}
+
+    def read_manifest(self):
+        manifest = {"settings": self.get_settings(), "tracks": {}}
+        if not os.path.isfile(self.path):
+            return manifest
+        if not os.path.isfile(self.manifest_path):
+            console.warn("No manifest for", self.path, "recreating it")
+            return manifest
+        if not self.is_readable():
+            # the update is written in place, a crash can damage the file
+            console.warn(self.path, "is damaged, recreating it")
+            return manifest
+        with open(self.manifest_path, "r") as f:
+            stored = json.load(f)
+        if stored["settings"] != manifest["settings"]:
+            console.warn("Settings of", self.path, "changed, recreating it")
+            return manifest
+        return stored
+
+    def is_readable(self):
+        self._import_filters()
+        try:
+            with h5py.File(self.path, "r") as h5f:
+                for group in h5f.values():
+                    if isinstance(group, h5py.Group):
+                        list(group.keys())
+        except (OSError, KeyError, RuntimeError):
+            return False
+        return True
+
+    def write_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_track_names(self):
+        return list(self.manifest["tracks"])
+
+    def get_track_info(self, name):
+        return self.manifest["tracks"][name]
+
+    def get_sources(self, files):
+        sources = []
+        for path in files:
+            stat = os.stat(path)
+            sources.append({"path": path,
+                            "size": stat.st_size,
+                            "mtime": stat.st_mtime})
+        return sources
+
+    def outdated(self, tracks):
+        # returns the new or changed tracks and the names of removed tracks
+        entries = self.manifest["tracks"]
+        changed = [(name, files) for name, files in tracks
+                   if name not in entries
+                   or entries[name]["sources"] != self.get_sources(files)]
+        names = set(name for name, _ in tracks)
+        removed = [name for name in entries if name not in names]
+        return changed, removed
+
+    def start_update(self, tracks):
+        """
+        Start bringing the cache up to date with the (name, files) in
+        `tracks`, removed tracks are dropped immediately
+
+        Returns the new or changed tracks, whose spectrograms have to be
+        passed to `add` before calling `finish_update`.
+        The manifest is written after every track,
+        so an interrupted update continues where it stopped.
+        The tracks are written in place, a file damaged by a crash
+        is recreated (see `read_manifest`).
+        """
+        self.h5f = None
+        changed, removed = self.outdated(tracks)
+        if not changed and not removed and os.path.isfile(self.path):
+            return []
+        console.info("Updating", self.path + ":", len(changed),
+                     "new or changed and", len(removed), "removed tracks")
+
+        entries = self.manifest["tracks"]
+        mode = "a" if entries else "w"
+        self._import_filters()
+        self.h5f = h5py.File(self.path, mode)
+        self.groups = [self.h5f.require_group("mashup"),
+                       self.h5f.require_group("vocal"),
+                       self.h5f.require_group("instrumental")]
+
+        # the space of deleted datasets is only reclaimed by h5repack
+        for name in removed:
+            for group in self.groups:
+                if name in group:
+                    del group[name]
+            del entries[name]
+        self.write_manifest()
+        self.changed = dict(changed)
+        return changed
+
+    def add(self, name, stfts, sample_rate):
+        mashup, vocal, instrumental = stfts
+        # relative error of the instrumental derived as mashup - vocal
+        residual = np.max(np.abs(mashup - vocal - instrumental)) / \
+            max(np.max(np.abs(mashup)), 1e-8)
+        if not self.store_instrumental:
+            stfts = stfts[:2]
+        for group, stft in zip(self.groups, stfts):
+            if name in group:
+                del group[name]
+            self.write(group, name, stft)
+        self.h5f.flush()
+        self.manifest["tracks"][name] = {
+            "sources": self.get_sources(self.changed[name]),
+            "sample_rate": sample_rate,
+            "bins": mashup.shape[0],
+            "frames": mashup.shape[1],
+            "residual": float(residual)}
+        self.write_manifest()
+
+    def finish_update(self, tracks):
+        if self.h5f is None:
+            return
+        # keep the order in which the tracks were found
+        entries = self.manifest["tracks"]
+        self.manifest["tracks"] = {name: entries[name]
+                                   for name, _ in tracks if name in entries}
+        self.write_manifest()
+
+        # list of track names for readers not using the manifest
+        if "names" in self.h5f:
+            del self.h5f["names"]
+        names = self.h5f.create_group("names")
+        names.create_dataset(name="track",
+                             data=[name.encode("utf8")
+                                   for name in self.get_track_names()])
+        self.h5f.close()
+        self.h5f = None
+
+    def open(self):
+        self._import_filters()
+        return h5py.File(self.path, "r")
+
+    def get_stem(self, h5f, stem):
+        if stem == "instrumental" and not self.store_instrumental:
+            return DerivedStem(Stem(self, h5f["mashup"]),
+                               Stem(self, h5f["vocal"]))
+        return Stem(self, h5f[stem])
+
+    def write(self, group, name, stft):
+        data, attrs = getattr(self, "_encode_" + self.config.storage)(stft)
+        # chunks hold whole spectra of as many frames as a chopped slice
+        scale = eval(self.config.chopparams).get("scale", 128)
+        chunks = (data.shape[0], min(scale, data.shape[1])) + data.shape[2:]
+        dataset = group.create_dataset(name=name, data=data, chunks=chunks,
+                                       **self.get_compression())
+        dataset.attrs["format"] = self.config.storage
+        for key, value in attrs.items():
+            dataset.attrs[key] = value
+
+    def read(self, dataset):
+        # datasets without format were written before formats existed
+        storage_format = dataset.attrs.get("format", "complex128")
+        return getattr(self, "_decode_" + storage_format)(dataset)
+
+    def get_compression(self):
+        compression = self.config.storage_compression
+        if not compression:
+            return {}
+        if compression in ["gzip", "lzf"]:
+            return {"compression": compression, "shuffle": True}
+        # lz4 and blosc are only available as plugins
+        import hdf5plugin
+        if compression == "lz4":
+            return dict(hdf5plugin.LZ4())
+        return dict(hdf5plugin.Blosc())
+
+    def _import_filters(self):
+        if self.config.storage_compression in ["lz4", "blosc"]:
+            import hdf5plugin  # noqa: F401
+
+    def _encode_complex128(self, stft):
+        return stft.astype(np.complex128), {}
+
+    def _decode_complex128(self, dataset):
+        return dataset[...]
+
+    def _encode_complex64(self, stft):
+        return stft.astype(np.complex64), {}
+
+    def _decode_complex64(self, dataset):
+        return dataset[...]
+
+    def _encode_float16(self, stft):
+        data = np.empty(stft.shape + (2,), dtype=np.float16)
+        data[:, :, 0] = np.real(stft)
+        data[:, :, 1] = np.imag(stft)
+        return data, {}
+
+    def _decode_float16(self, dataset):
+        data = dataset[...].astype(np.float32)
+        return data.view(np.complex64)[:, :, 0]
+
+    def _encode_log_amplitude(self, stft):
+        # quantized log amplitude, the phase is lost
+        amplitude = np.log1p(np.abs(stft))
+        scale = max(np.max(amplitude), 1e-8) / 65535
+        data = np.round(amplitude / scale).astype(np.uint16)
+        return data, {"scale": scale}
+
+    def _decode_log_amplitude(self, dataset):
+        data = dataset[...].astype(np.float32)
+        return np.expm1(data * dataset.attrs["scale"])
+
+
+class Stem(Mapping):
+    """
+    Read-only mapping of track names to the decoded spectrograms of one stem
+
+    The spectrograms are read from the file on every access.
+    """
+    def __init__(self, storage, group):
+        self.storage = storage
+        self.group = group
+
+    def __getitem__(self, name):
+        return self.storage.read(self.group[name])
+
+    def __iter__(self):
+        return iter(self.group)
+
+    def __len__(self):
+        return len(self.group)
+
+
+class DerivedStem(Stem):
+    """
+    Read-only mapping of track names to the difference of two stems,
+    i.e. the instrumental derived as mashup - vocal
+    """
+    def __init__(self, stem, subtrahend):
+        self.stem = stem
+        self.subtrahend = subtrahend
+
+    def __getitem__(self, name):
+        return self.stem[name] - self.subtrahend[name]
+
+    def __iter__(self):
+        return iter(self.stem)
+
+    def __len__(self):
+        return len(self.stem)
+
+
+class PreparedStorage(object):
+    """
+    Cache of the prepared (converted and normalized) tracks
+
+    One file next to the spectrogram cache per `key`, which identifies
+    the settings the tracks were prepared with.
+    Tracks whose manifest entry (sources, sample rate and shape) changed
+    since they were prepared are recreated.
+    """
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.path = "%s_prepared_%s.h5" % (os.path.splitext(storage.path)[0],
+                                           key)
+        self.h5f = None
+
+    def get(self, name, prepare):
+        if self.h5f is None:
+            self.h5f = h5py.File(self.path, "a")
+        info = json.dumps(self.storage.get_track_info(name), sort_keys=True)
+        if name in self.h5f and self.h5f[name].attrs.get("info") == info:
+            group = self.h5f[name]
+            return group["mashup"][...], group["output"][...]
+
+        mashup, output = prepare(name)
+        mashup = mashup.astype(config.dtype, copy=False)
+        output = output.astype(config.dtype, copy=False)
+        if name in self.h5f:
+            del self.h5f[name]
+        group = self.h5f.create_group(name)
+        group.create_dataset(name="mashup", data=mashup)
+        group.create_dataset(name="output", data=output)
+        # written last, marks the track as complete
+        group.attrs["info"] = info
+        self.h5f.flush()
+        return mashup, output
+
+    def get_energy(self, name, key, compute):
+        # energy maps of the choppers, only valid after `get`
+        # as they are removed together with the outdated track
+        group = self.h5f[name]
+        if key in group:
+            energy = group[key]
+            return energy.attrs["mean_deviation"], \
+                energy["tiles"][...], energy["columns"][...]
+
+        mean_deviation, tiles, columns = compute()
+        energy = group.create_group(key)
+        energy.create_dataset(name="tiles", data=tiles)
+        energy.create_dataset(name="columns", data=columns)
+        energy.attrs["mean_deviation"] = mean_deviation
+        self.h5f.flush()
+        return mean_deviation, tiles, columns
+
+
+class PcmCache(object):
+    """
+    Content addressed cache of decoded audio files
+
+    The audio is stored as .npy file named by the hash of the file content
+    and the resampling settings and loaded as memory map.
+    """
+    def __init__(self, path, sample_rate, resampler):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.resampler = resampler
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+    def get_key(self, file_path):
+        content = md5()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                content.update(block)
+        settings = "%s:%s:%s" % (content.hexdigest(), self.sample_rate,
+                                 self.resampler)
+        return md5(settings.encode()).hexdigest()
+
+    def load(self, file_path):
+        key = self.get_key(file_path)
+        # the sample rate is part of the name,
+        # as it is only known after decoding without resampling
+        cached = glob.glob(os.path.join(self.path, key + "_*.npy"))
+        if cached:
+            name = os.path.splitext(os.path.basename(cached[0]))[0]
+            sample_rate = int(name.split("_")[1])
+            return np.load(cached[0], mmap_mode="r"), sample_rate
+
+        audio, sample_rate = conversion.load_audio_file(
+            file_path, self.sample_rate, self.resampler)
+        path = os.path.join(self.path, "%s_%d.npy" % (key, sample_rate))
+        # identical files may be decoded by several workers at once
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, audio)
+        os.replace(tmp_path, path)
+        return audio, sample_rate
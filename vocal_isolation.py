@@ -18,6 +18,7 @@ import string
 import os
 import sys
 import signal
+from math import ceil
 
 import numpy as np
 from keras.utils import plot_model
@@ -28,7 +29,7 @@ import conversion
 from data import Data, remove_track_boundaries
 from config import config
 from metrics import Metrics
-from checkpointer import Checkpointer
+from checkpointer import Checkpointer, TrainingState
 from modeler import Modeler
 from loss import Loss
 from optimizer import Optimizer
@@ -52,42 +53,110 @@ class VocalIsolation:
         # this should represent how much the input gets downscaled
         # in the middle of the network
         self.peakDownscaleFactor = 4
+        # state of the running training
+        self.state = None
 
     def train(self, data, epochs, batch=8, start_epoch=0):
         x_train, y_train = data.train()
-        x_valid, y_valid = data.valid()
+        self.data = data
+        if self.config.validation == "tracks":
+            # validated by the TrackValidation checkpoint
+            validation_data = None
+            validation_size = "%d tracks" % len(data.validation_tracks)
+            x_valid, y_valid = None, None
+            if "error_visualization" in self.config.checkpoints:
+                x_valid, y_valid = data.valid()
+        else:
+            x_valid, y_valid = data.valid()
+            validation_data = (x_valid, y_valid)
+            validation_size = "%d examples" % len(x_valid)
         self.x_valid, self.y_valid = x_valid, y_valid
-        checkpointer = Checkpointer(self)
-        checkpoints = checkpointer.get()
-        if self.config.batch_generator != "keras":
-            batch_generator = Batch().get()
         if self.config.epoch_steps:
             epoch_steps = self.config.epoch_steps
         else:
-            epoch_steps = remove_track_boundaries(x_train).shape[0]
+            epoch_steps = sum(len(track) for track in x_train)
         epoch_steps = epoch_steps // batch
+        if self.config.batch_generator == "keras":
+            state_steps = ceil(sum(len(track) for track in x_train) / batch)
+        else:
+            state_steps = epoch_steps
+        self.state = TrainingState(self, state_steps)
+        if self.config.resume:
+            self.state.load(self.config.resume)
+            epochs = start_epoch + epochs - self.state.epoch
+            start_epoch = self.state.epoch
+            if epochs <= 0:
+                console.warn("The resumed training already finished",
+                             self.state.epoch, "epochs")
+        elif not self.config.seed:
+            # a resumed training needs the seed of the batch stream
+            self.config.set("seed", str(random.randrange(2**32)))
+        console.info("Seed", self.config.seed)
+        checkpointer = Checkpointer(self)
+        checkpoints = checkpointer.get()
+        # saved after the other checkpoints of the epoch
+        checkpoints.append(self.state)
+        self.state.callbacks = checkpoints
+        # stats of the batch generator for the checkpoints
+        self.batches = None
+        if self.config.batch_generator != "keras":
+            batches = Batch()
+            batches.norms = data.norms
+            batches.sampling = data.sampling
+            batch_generator = batches.get()
+            self.batches = batches
+        history = None
         while epochs > 0:
             end_epoch = start_epoch + epochs
             console.log("Training for", epochs, "epochs on",
                         epoch_steps * batch, "examples")
-            console.log("Validate on", len(x_valid), "examples")
+            console.log("Validate on", validation_size)
             if self.config.batch_generator == "keras":
-                x_train = remove_track_boundaries(x_train)
-                y_train = remove_track_boundaries(y_train)
+                if self.state.step:
+                    console.warn("The keras batch generator resumes at the "
+                                 "beginning of epoch", start_epoch + 1)
+                    self.state.step = 0
+                x_train = np.asarray(remove_track_boundaries(x_train))
+                y_train = np.asarray(remove_track_boundaries(y_train))
                 history = self.model.fit(
                     x_train, y_train, batch_size=batch,
                     initial_epoch=start_epoch, epochs=end_epoch,
-                    validation_data=(x_valid, y_valid),
+                    validation_data=validation_data,
                     callbacks=checkpoints)
             else:
-                history = self.model.fit_generator(
-                    batch_generator(x_train, y_train, batch_size=batch),
-                    initial_epoch=start_epoch, epochs=end_epoch,
-                    steps_per_epoch=epoch_steps,
-                    validation_data=(x_valid, y_valid),
-                    callbacks=checkpoints)
+                fits = [(start_epoch, end_epoch, epoch_steps)]
+                if self.state.step:
+                    # the interrupted epoch is finished first, the second fit
+                    # restarts callbacks that keep state over the epochs
+                    # like the early stopping with its best value and wait
+                    fits = [(start_epoch, start_epoch + 1,
+                             epoch_steps - self.state.step),
+                            (start_epoch + 1, end_epoch, epoch_steps)]
+                history = None
+                for first, last, steps in fits:
+                    if first == last:
+                        continue
+                    # continue the stream of batches already trained on
+                    batches.skip = self.state.batches
+                    fit = self.model.fit_generator(
+                        batch_generator(x_train, y_train, batch_size=batch),
+                        initial_epoch=first, epochs=last,
+                        steps_per_epoch=steps,
+                        validation_data=validation_data,
+                        callbacks=checkpoints)
+                    if history is None:
+                        history = fit
+                    else:
+                        history.epoch += fit.epoch
+                        for name, values in fit.history.items():
+                            history.history.setdefault(name, []) \
+                                .extend(values)
             console.notify(str(epochs) + " Epochs Complete!",
                            "Training on", data.in_path, "with size", batch)
+            if data.cache is not None:
+                console.info("Track cache:", data.cache)
+            if self.config.batch_generator != "keras":
+                console.info("Batches:", batches)
 
             start_epoch += epochs
             if self.config.quit:
@@ -106,8 +175,8 @@ class VocalIsolation:
                     if not save.lower().startswith("n"):
                         weight_path = ''.join(random.choice(string.digits)
                                               for _ in range(16)) + ".h5"
-                        os.path.join(os.path.dirname(config.weights),
-                                     weight_path)
+                        weight_path = os.path.join(
+                            os.path.dirname(config.weights), weight_path)
                         console.log("Saving intermediate weights to",
                                     weight_path)
                         self.save_weights(weight_path)
@@ -128,6 +197,9 @@ class VocalIsolation:
                              self.config.batch, self.config.start_epoch)
 
         self.save_weights(self.config.weights)
+        if history is None:
+            # nothing left to train
+            return history
         metrics_path = os.path.join(self.config.logs, "metrics")
         with open(metrics_path, "w") as f:
             metric_names = list(history.history.keys())
@@ -152,45 +224,66 @@ class VocalIsolation:
         chopper.params = "{'scale': %d}" % self.config.inference_slice
         chop = chopper.get(both=False)
 
-        slices = chop(spectrogram)
+        # the last slice may be empty
+        slices = [slice for slice in chop(spectrogram) if slice.shape[1]]
 
         normalizer = Normalizer()
-        normalize = normalizer.get(both=False)
-        denormalize = normalizer.get_reverse()
-
-        new_spectrogram = np.zeros((spectrogram.shape[0], 0, channels))
+        # the slices are normalized in the batch, which is a copy
+        normalize = normalizer.get(both=False, copy=False)
+        denormalize = normalizer.get_reverse(copy=False)
+
+        # every slice is padded to its own grid like a single prediction,
+        # so the shorter last slice is predicted in a batch of its own
+        grid = self.peakDownscaleFactor
+        height = ceil(spectrogram.shape[0] / grid) * grid
+        groups = []
         for slice in slices:
-            # normalize
-            slice, norm = normalize(slice)
-
-            epanded_spectrogram = conversion.expand_to_grid(
-                slice, self.peakDownscaleFactor, channels)
-            epanded_spectrogram_with_batch_and_channels = \
-                epanded_spectrogram[np.newaxis, :, :]
-
-            predicted_spectrogram_with_batch_and_channels = self.model.predict(
-                epanded_spectrogram_with_batch_and_channels)
-            # o /// o
-            predicted_spectrogram = \
-                predicted_spectrogram_with_batch_and_channels[0, :, :, :]
-            local_spectrogram = predicted_spectrogram[:slice.shape[0],
-                                                      :slice.shape[1], :]
-
-            # de-normalize
-            local_spectrogram = denormalize(local_spectrogram, norm)
-
-            new_spectrogram = np.concatenate(
-                    (new_spectrogram, local_spectrogram), axis=1)
+            width = ceil(slice.shape[1] / grid) * grid
+            if groups and groups[-1][0] == width \
+                    and len(groups[-1][1]) < self.config.inference_batch:
+                groups[-1][1].append(slice)
+            else:
+                groups.append((width, [slice]))
+
+        # one batch buffer per width, the first group is the largest
+        buffers = {}
+        new_spectrogram = np.empty(spectrogram.shape[:2] + (channels,),
+                                   dtype=spectrogram.dtype)
+        start = 0
+        for width, group in groups:
+            if width not in buffers:
+                buffers[width] = np.zeros(
+                    (len(group), height, width, channels),
+                    dtype=spectrogram.dtype)
+            batch = buffers[width]
+            norms = []
+            for i, slice in enumerate(group):
+                frames = slice.shape[1]
+                batch[i, :, frames:] = 0
+                batch[i, :slice.shape[0], :frames] = slice
+                normalized, norm = normalize(
+                    batch[i, :slice.shape[0], :frames])
+                batch[i, :slice.shape[0], :frames] = normalized
+                norms.append(norm)
+
+            predicted = self.model.predict(batch[:len(group)],
+                                           batch_size=len(group))
+            for slice, prediction, norm in zip(group, predicted, norms):
+                frames = slice.shape[1]
+                new_spectrogram[:, start:start + frames] = denormalize(
+                    prediction[:slice.shape[0], :frames], norm)
+                start += frames
         console.log("Processed spectrogram")
         return spectrogram, new_spectrogram
 
     def infer(self, path, fft_window_size, phase_iterations=10,
               learn_phase=False, channels=1):
         console.log("Attempting to isolate vocals from", path)
-        audio, sample_rate = conversion.load_audio_file(path)
+        audio, sample_rate = conversion.load_audio_file(
+            path, self.config.sample_rate, self.config.resampler)
         spectrogram = conversion.audio_file_to_spectrogram(
             audio, fft_window_size=fft_window_size,
-            learn_phase=self.config.learn_phase)
+            learn_phase=self.config.learn_phase, dtype=self.config.dtype)
         console.log("Retrieved spectrogram; processing...")
 
         info = self.process_spectrogram(spectrogram, channels)
@@ -247,11 +340,15 @@ class VocalIsolation:
 
 
 def get_signal_handler(vocal_isolation):
-    def signal_handler(signal, frame):
-        save = input("Should we save intermediate weights [y/n]? ")
-        if not save.lower().startswith("n"):
-            vocal_isolation.save_weights(vocal_isolation.config.weights)
-        sys.exit(0)
+    def signal_handler(signum, frame):
+        state = vocal_isolation.state
+        if state is not None and state.training and state.interrupted is None:
+            console.warn("Interrupted, saving the training state "
+                         "after the current step")
+            state.interrupted = signum
+        else:
+            # outside of the training or interrupted again
+            sys.exit(128 + signum)
     return signal_handler
 
 
@@ -265,7 +362,7 @@ if __name__ == "__main__":
     if len(files) == 0 and config.data:
         console.log("No files provided; attempting to train on " +
                     config.data + "...")
-        if config.batch_generator.startswith("random") \
+        if config.batch_generator in ["random", "remix"] \
                 and config.epoch_steps == 0:
             console.error("EPOCH_STEPS is not set,"
                           " but cannot be determined from data.")
@@ -276,7 +373,9 @@ if __name__ == "__main__":
         console.h1("Loading Data")
         data = Data()
         console.h1("Training Model")
-        signal.signal(signal.SIGINT, get_signal_handler(vocal_isolation))
+        handler = get_signal_handler(vocal_isolation)
+        signal.signal(signal.SIGINT, handler)
+        signal.signal(signal.SIGTERM, handler)
         vocal_isolation.run(data)
     elif len(files) > 0:
         console.log("Weights provided; performing inference on " +